@@ -1,19 +1,212 @@
 from __future__ import annotations
 
 import asyncio
-from collections import Counter
-from typing import Optional
+import contextlib
+import itertools
+import sqlite3
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import AsyncIterator, Iterable, Optional, Sequence, TypeVar
 
 import aiosqlite
 
+T = TypeVar("T")
+
+# Горячие SQL-запросы ingest-пути вынесены в константы: sqlite3 кэширует подготовленные
+# statements по точному тексту запроса, поэтому один и тот же текст не перекомпилируется.
+STATEMENT_CACHE_SIZE = 256
+
+# created_at — unix-время: целое число вместо форматирования ISO-строки на каждую вставку.
+MESSAGES_TABLE_DDL = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    author_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    created_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+);
+"""
+MESSAGE_EXISTS_SQL = "SELECT 1 FROM messages WHERE chat_id = ? AND text = ? LIMIT 1"
+INSERT_MESSAGE_SQL = """
+INSERT INTO messages(chat_id, author_id, text)
+VALUES (?, ?, ?)
+"""
+UPSERT_START2_SQL = """
+INSERT INTO starts(chat_id, w1, w2, cnt)
+VALUES (?, ?, ?, 1)
+ON CONFLICT(chat_id, w1, w2)
+DO UPDATE SET cnt = cnt + 1
+"""
+UPSERT_START3_SQL = """
+INSERT INTO starts3(chat_id, w1, w2, w3, cnt)
+VALUES (?, ?, ?, ?, 1)
+ON CONFLICT(chat_id, w1, w2, w3)
+DO UPDATE SET cnt = cnt + 1
+"""
+# Версия схемы в PRAGMA user_version: 1 — токены хранятся как id из vocab;
+# 2 — таблицы модели WITHOUT ROWID; 3 — messages.created_at в unix-времени (INTEGER).
+SCHEMA_VERSION = 3
+
+# Таблицы модели и их ключевые колонки (id токенов из vocab):
+# starts/transitions — n=2 (legacy + fallback слой), starts3/transitions3 — основной n=3,
+# transitions1 — n=1 для backoff (w1 -> w2).
+MODEL_TABLES: dict[str, tuple[str, ...]] = {
+    "starts": ("w1", "w2"),
+    "transitions": ("w1", "w2", "w3"),
+    "starts3": ("w1", "w2", "w3"),
+    "transitions3": ("w1", "w2", "w3", "w4"),
+    "transitions1": ("w1", "w2"),
+}
+
+# Сколько соответствий слово -> id держать в памяти на ingest-пути.
+VOCAB_CACHE_LIMIT = 65536
+# Сколько результатов message_exists помнить на один чат.
+SEEN_TEXTS_LIMIT = 4096
+# Сколько hash(text) сообщений держать суммарно по всем чатам для message_exists:
+# ~65 байт на запись, т.е. до ~17 МБ. При переполнении вытесняются целые чаты.
+MESSAGE_HASHES_LIMIT = 262144
+# Сколько ожидающих сообщений фоновый writer коммитит одной транзакцией.
+WRITE_BATCH_MAX = 64
+# Read-only соединения для get_*/message_exists и их настройки.
+READER_POOL_SIZE = 4
+READER_PRAGMAS = (
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA cache_size=-64000;",
+    "PRAGMA busy_timeout=5000;",
+    "PRAGMA mmap_size=268435456;",
+)
+
+# Минимальный гарантированный лимит bind-параметров в одном statement у старых сборок SQLite.
+MAX_SQL_VARIABLES = 999
+
+# Объёмы всех чатов разом: PRIMARY KEY начинается с chat_id, GROUP BY идёт по порядку ключа.
+ALL_VOLUMES3_SQL = "SELECT chat_id, SUM(cnt) FROM transitions3 GROUP BY chat_id"
+ALL_VOLUMES2_SQL = "SELECT chat_id, SUM(cnt) FROM transitions GROUP BY chat_id"
+# Все тексты одного чата: покрывающий проход по idx_messages_dup(chat_id, text),
+# без сортировки и без чтения строк таблицы.
+CHAT_MESSAGE_TEXTS_SQL = "SELECT text FROM messages WHERE chat_id = ?"
+
+
+def model_table_ddl(table: str, key_columns: tuple[str, ...]) -> str:
+    # WITHOUT ROWID: строки лежат прямо в B-дереве PRIMARY KEY, без отдельного rowid-дерева
+    # и без дублирования ключа в автоиндексе.
+    columns = "".join(f"{column} INTEGER NOT NULL, " for column in key_columns)
+    return (
+        f"CREATE TABLE IF NOT EXISTS {table} (chat_id INTEGER NOT NULL, {columns}"
+        f"cnt INTEGER NOT NULL DEFAULT 0, PRIMARY KEY(chat_id, {', '.join(key_columns)}))"
+        " WITHOUT ROWID;"
+    )
+
+
+@lru_cache(maxsize=64)
+def build_counts_upsert_sql(table: str, key_columns: tuple[str, ...], rows: int) -> str:
+    """Upsert пачки счётчиков через CTE: chat_id передаётся последним параметром один раз."""
+    batch_columns = (*key_columns, "cnt")
+    row_placeholder = "(" + ", ".join("?" * len(batch_columns)) + ")"
+    return (
+        f"WITH batch({', '.join(batch_columns)}) AS (VALUES {', '.join([row_placeholder] * rows)})\n"
+        f"INSERT INTO {table}(chat_id, {', '.join(batch_columns)})\n"
+        f"SELECT ?, {', '.join(batch_columns)} FROM batch WHERE true\n"
+        f"ON CONFLICT(chat_id, {', '.join(key_columns)})\n"
+        "DO UPDATE SET cnt = cnt + excluded.cnt"
+    )
+
+
+@lru_cache(maxsize=64)
+def build_transitions_batch_sql(rows: int) -> str:
+    """SELECT переходов n=2 сразу для нескольких ключей (chat_id, w1, w2)."""
+    return (
+        f"WITH keys(chat_id, w1, w2) AS (VALUES {', '.join(['(?, ?, ?)'] * rows)})\n"
+        "SELECT keys.chat_id, keys.w1, keys.w2, v.word, t.cnt\n"
+        "FROM keys\n"
+        "JOIN vocab AS v1 ON v1.word = keys.w1\n"
+        "JOIN vocab AS v2 ON v2.word = keys.w2\n"
+        "JOIN transitions AS t ON t.chat_id = keys.chat_id AND t.w1 = v1.id AND t.w2 = v2.id\n"
+        "JOIN vocab AS v ON v.id = t.w3"
+    )
+
+
+def count_ngrams(
+    tokens: Sequence[T],
+) -> tuple[
+    dict[tuple[T, T], int],
+    dict[tuple[T, T, T], int],
+    dict[tuple[T, T, T, T], int],
+]:
+    """Считает 2-, 3- и 4-граммы сообщения за один проход по токенам."""
+    grams2: dict[tuple[T, T], int] = {}
+    grams3: dict[tuple[T, T, T], int] = {}
+    grams4: dict[tuple[T, T, T, T], int] = {}
+    n = len(tokens)
+    for i in range(n - 1):
+        a, b = tokens[i], tokens[i + 1]
+        key2 = (a, b)
+        grams2[key2] = grams2.get(key2, 0) + 1
+        if i + 2 < n:
+            c = tokens[i + 2]
+            key3 = (a, b, c)
+            grams3[key3] = grams3.get(key3, 0) + 1
+            if i + 3 < n:
+                key4 = (a, b, c, tokens[i + 3])
+                grams4[key4] = grams4.get(key4, 0) + 1
+    return grams2, grams3, grams4
+
+
+@dataclass(slots=True)
+class _PendingMessage:
+    chat_id: int
+    author_id: int
+    raw_text: str
+    tokens: list[str]
+    future: asyncio.Future[int]
+
+
+def _fail_pending(item: _PendingMessage, exc: BaseException) -> None:
+    if not item.future.done():
+        item.future.set_exception(exc)
+
 
 class Database:
     """Слой доступа к SQLite для хранения сообщений и статистики variable-order Markov."""
 
     def __init__(self, path: str) -> None:
+        # Читатели открывают тот же файл отдельными соединениями (file:...?mode=ro), а у
+        # :memory:, временной БД ("") и готовых URI общего файла для них нет.
+        if path in ("", ":memory:") or path.startswith("file:"):
+            raise ValueError(f"Database path must be a file path, got {path!r}")
         self.path = path
         self._conn: Optional[aiosqlite.Connection] = None
+        # Пул read-only соединений: в WAL читатели не ждут writer и self._lock.
+        self._readers: Optional[asyncio.Queue[aiosqlite.Connection]] = None
+        self._reader_conns: list[aiosqlite.Connection] = []
+        # Синхронное read-only соединение для точечного SELECT в message_exists (его
+        # единственный пользователь): запрос по индексу выполняется за микросекунды, и
+        # переход в поток aiosqlite обходится дороже самого запроса.
+        # Используется только из потока event loop.
+        self._sync_reader: Optional[sqlite3.Connection] = None
         self._lock = asyncio.Lock()
+        # Накопленные SUM(cnt) по transitions3/transitions для каждого чата: загружаются
+        # для всех чатов в init() и дальше растут в памяти; отсутствие чата означает 0.
+        self._vol3: dict[int, int] = {}
+        self._vol2: dict[int, int] = {}
+        # LRU слово -> id из vocab; пополняется только после успешного COMMIT.
+        self._vocab_ids: OrderedDict[str, int] = OrderedDict()
+        # LRU результатов message_exists по чатам: text -> есть ли такое сообщение.
+        self._seen_texts: dict[int, OrderedDict[str, bool]] = {}
+        # hash(text) всех сообщений чата: загружается при первом message_exists по чату
+        # и растёт после COMMIT, так что промах — точный отрицательный ответ без SELECT.
+        # Чаты упорядочены по последнему обращению; сверх MESSAGE_HASHES_LIMIT записей
+        # вытесняются самые давние чаты целиком.
+        self._message_hashes: dict[int, set[int]] = {}
+        self._message_hash_count = 0
+        # Хэши, закоммиченные, пока множество чата загружается из БД.
+        self._hashes_loading: dict[int, set[int]] = {}
+        # Чаты, чья история одна не влезает в лимит: для них всегда SELECT.
+        self._hashes_oversized: set[int] = set()
+        self._queue: asyncio.Queue[_PendingMessage] = asyncio.Queue()
+        self._writer_task: Optional[asyncio.Task[None]] = None
 
     async def _get_conn(self) -> aiosqlite.Connection:
         if self._conn is None:
@@ -24,108 +217,192 @@ class Database:
         if self._conn is not None:
             return
 
-        self._conn = await aiosqlite.connect(self.path)
+        # isolation_level=None: транзакции открываются явно (BEGIN IMMEDIATE), без неявных BEGIN.
+        self._conn = await aiosqlite.connect(
+            self.path, isolation_level=None, cached_statements=STATEMENT_CACHE_SIZE
+        )
         db = await self._get_conn()
 
+        # page_size действует только для новой базы (до первой записи и перехода в WAL);
+        # у существующих файлов SQLite молча оставляет прежний размер страницы.
+        await db.execute("PRAGMA page_size=8192;")
         await db.execute("PRAGMA journal_mode=WAL;")
-        await db.execute("PRAGMA foreign_keys=ON;")
-
+        # В WAL-режиме synchronous=NORMAL безопасен и убирает fsync на каждый commit.
+        await db.execute("PRAGMA synchronous=NORMAL;")
+        await db.execute("PRAGMA temp_store=MEMORY;")
+        await db.execute("PRAGMA cache_size=-64000;")
+        await db.execute("PRAGMA busy_timeout=5000;")
+        await db.execute("PRAGMA mmap_size=268435456;")
+        # foreign_keys не включаем: в схеме нет FOREIGN KEY, проверять на DELETE/UPSERT нечего.
+
+        await db.execute(MESSAGES_TABLE_DDL)
         await db.execute(
             """
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL,
-                author_id INTEGER NOT NULL,
-                text TEXT NOT NULL,
-                created_at TEXT NOT NULL DEFAULT (datetime('now'))
+            CREATE TABLE IF NOT EXISTS vocab (
+                id INTEGER PRIMARY KEY,
+                word TEXT NOT NULL UNIQUE
             );
             """
         )
 
-        # Таблицы n=2 (legacy + fallback слой).
+        cursor = await db.execute("PRAGMA user_version;")
+        user_version = int((await cursor.fetchone())[0])
+        if user_version < SCHEMA_VERSION:
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                if user_version < 1:
+                    # Переносит данные сразу в таблицы актуального формата.
+                    await self._migrate_tokens_to_vocab(db)
+                elif user_version < 2:
+                    await self._migrate_model_tables_without_rowid(db)
+                if user_version < 3:
+                    await self._migrate_created_at_to_unix_time(db)
+                await db.execute(f"PRAGMA user_version={SCHEMA_VERSION};")
+                await db.execute("COMMIT")
+            except BaseException:
+                await db.execute("ROLLBACK")
+                raise
+        for table, key_columns in MODEL_TABLES.items():
+            await db.execute(model_table_ddl(table, key_columns))
+
+        # (chat_id, text) обслуживает и проверку дубликатов, и выборки по chat_id.
+        await db.execute("DROP INDEX IF EXISTS idx_messages_chat_id;")
         await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS starts (
-                chat_id INTEGER NOT NULL,
-                w1 TEXT NOT NULL,
-                w2 TEXT NOT NULL,
-                cnt INTEGER NOT NULL DEFAULT 0,
-                PRIMARY KEY(chat_id, w1, w2)
-            );
-            """
+            "CREATE INDEX IF NOT EXISTS idx_messages_dup ON messages(chat_id, text);"
         )
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS transitions (
-                chat_id INTEGER NOT NULL,
-                w1 TEXT NOT NULL,
-                w2 TEXT NOT NULL,
-                w3 TEXT NOT NULL,
-                cnt INTEGER NOT NULL DEFAULT 0,
-                PRIMARY KEY(chat_id, w1, w2, w3)
-            );
-            """
+        # В WITHOUT ROWID-таблицах PRIMARY KEY сам хранит cnt: выборки по chat_id и SUM(cnt)
+        # читают диапазон первичного ключа, а любой вторичный индекс был бы копией таблицы
+        # и только удорожал запись. Удаляем индексы, оставшиеся от прежних схем.
+        for legacy_index in (
+            "idx_starts_lookup",
+            "idx_starts3_chat_id",
+            "idx_starts3_cover",
+            "idx_transitions_lookup",
+            "idx_transitions3_lookup",
+            "idx_transitions1_lookup",
+            "idx_transitions_sum",
+            "idx_transitions3_sum",
+            "idx_transitions1_sum",
+        ):
+            await db.execute(f"DROP INDEX IF EXISTS {legacy_index};")
+        await self._load_all_volumes(db)
+        await self._open_readers()
+        self._writer_task = asyncio.create_task(self._writer_loop())
+
+    async def _open_readers(self) -> None:
+        uri = Path(self.path).resolve().as_uri() + "?mode=ro"
+        self._sync_reader = sqlite3.connect(
+            uri, uri=True, cached_statements=STATEMENT_CACHE_SIZE
         )
+        for pragma in READER_PRAGMAS:
+            self._sync_reader.execute(pragma)
+        # Синхронный запрос идёт в потоке event loop: ожидание блокировки заморозило бы
+        # весь бот, поэтому при SQLITE_BUSY он сразу уступает пулу асинхронных читателей.
+        self._sync_reader.execute("PRAGMA busy_timeout=0;")
+        self._readers = asyncio.Queue()
+        for _ in range(READER_POOL_SIZE):
+            reader = await aiosqlite.connect(
+                uri, uri=True, cached_statements=STATEMENT_CACHE_SIZE
+            )
+            for pragma in READER_PRAGMAS:
+                await reader.execute(pragma)
+            self._reader_conns.append(reader)
+            self._readers.put_nowait(reader)
 
-        # Новые таблицы n=3.
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS starts3 (
-                chat_id INTEGER NOT NULL,
-                w1 TEXT NOT NULL,
-                w2 TEXT NOT NULL,
-                w3 TEXT NOT NULL,
-                cnt INTEGER NOT NULL DEFAULT 0,
-                PRIMARY KEY(chat_id, w1, w2, w3)
-            );
-            """
-        )
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS transitions3 (
-                chat_id INTEGER NOT NULL,
-                w1 TEXT NOT NULL,
-                w2 TEXT NOT NULL,
-                w3 TEXT NOT NULL,
-                w4 TEXT NOT NULL,
-                cnt INTEGER NOT NULL DEFAULT 0,
-                PRIMARY KEY(chat_id, w1, w2, w3, w4)
-            );
-            """
-        )
+    def _get_sync_reader(self) -> sqlite3.Connection:
+        if self._sync_reader is None:
+            raise RuntimeError("Database is not initialized. Call init() first.")
+        return self._sync_reader
 
-        # Таблица n=1 для backoff: (w1 -> w2)
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS transitions1 (
-                chat_id INTEGER NOT NULL,
-                w1 TEXT NOT NULL,
-                w2 TEXT NOT NULL,
-                cnt INTEGER NOT NULL DEFAULT 0,
-                PRIMARY KEY(chat_id, w1, w2)
-            );
-            """
+    @contextlib.asynccontextmanager
+    async def _reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        if self._readers is None:
+            raise RuntimeError("Database is not initialized. Call init() first.")
+        reader = await self._readers.get()
+        try:
+            yield reader
+        finally:
+            self._readers.put_nowait(reader)
+
+    async def _migrate_tokens_to_vocab(self, db: aiosqlite.Connection) -> None:
+        """Переводит TEXT-колонки w1..w4 таблиц модели на id из vocab (схема до user_version=1)."""
+        cursor = await db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ({})".format(
+                ", ".join("?" * len(MODEL_TABLES))
+            ),
+            tuple(MODEL_TABLES),
         )
+        legacy_tables = {row[0] for row in await cursor.fetchall()}
+        for table in legacy_tables:
+            await db.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy;")
 
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id);")
-        await db.execute(
-            "CREATE INDEX IF NOT EXISTS idx_starts_lookup ON starts(chat_id, w1, w2);"
-        )
-        await db.execute(
-            "CREATE INDEX IF NOT EXISTS idx_transitions_lookup ON transitions(chat_id, w1, w2);"
-        )
-        await db.execute(
-            "CREATE INDEX IF NOT EXISTS idx_starts3_chat_id ON starts3(chat_id);"
-        )
-        await db.execute(
-            "CREATE INDEX IF NOT EXISTS idx_transitions3_lookup ON transitions3(chat_id, w1, w2, w3);"
+        for table in legacy_tables:
+            for column in MODEL_TABLES[table]:
+                await db.execute(
+                    f"INSERT OR IGNORE INTO vocab(word) SELECT {column} FROM {table}_legacy;"
+                )
+
+        for table in legacy_tables:
+            key_columns = MODEL_TABLES[table]
+            await db.execute(model_table_ddl(table, key_columns))
+            joins = " ".join(
+                f"JOIN vocab v_{column} ON v_{column}.word = t.{column}" for column in key_columns
+            )
+            await db.execute(
+                f"""
+                INSERT INTO {table}(chat_id, {", ".join(key_columns)}, cnt)
+                SELECT t.chat_id, {", ".join(f"v_{column}.id" for column in key_columns)}, t.cnt
+                FROM {table}_legacy AS t {joins}
+                """
+            )
+            await db.execute(f"DROP TABLE {table}_legacy;")
+
+    async def _migrate_model_tables_without_rowid(self, db: aiosqlite.Connection) -> None:
+        """Пересоздаёт таблицы модели схемы user_version=1 в формате WITHOUT ROWID."""
+        for table, key_columns in MODEL_TABLES.items():
+            await db.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy;")
+            await db.execute(model_table_ddl(table, key_columns))
+            columns = ", ".join(("chat_id", *key_columns, "cnt"))
+            await db.execute(
+                f"INSERT INTO {table}({columns}) SELECT {columns} FROM {table}_legacy;"
+            )
+            await db.execute(f"DROP TABLE {table}_legacy;")
+
+    async def _migrate_created_at_to_unix_time(self, db: aiosqlite.Connection) -> None:
+        """Переводит messages.created_at из ISO-строки datetime('now') в unix-время."""
+        cursor = await db.execute(
+            "SELECT type FROM pragma_table_info('messages') WHERE name = 'created_at'"
         )
+        row = await cursor.fetchone()
+        if row is None or row[0].upper() == "INTEGER":
+            return
+        await db.execute("ALTER TABLE messages RENAME TO messages_legacy;")
+        await db.execute(MESSAGES_TABLE_DDL)
         await db.execute(
-            "CREATE INDEX IF NOT EXISTS idx_transitions1_lookup ON transitions1(chat_id, w1);"
+            """
+            INSERT INTO messages(id, chat_id, author_id, text, created_at)
+            SELECT id, chat_id, author_id, text,
+                   COALESCE(CAST(strftime('%s', created_at) AS INTEGER), 0)
+            FROM messages_legacy
+            """
         )
-        await db.commit()
+        await db.execute("DROP TABLE messages_legacy;")
 
     async def close(self) -> None:
+        if self._writer_task is not None:
+            # Дописываем всё, что уже поставлено в очередь, и только потом гасим writer.
+            await self._queue.join()
+            self._writer_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._writer_task
+            self._writer_task = None
+        if self._sync_reader is not None:
+            self._sync_reader.close()
+            self._sync_reader = None
+        for reader in self._reader_conns:
+            await reader.close()
+        self._reader_conns = []
+        self._readers = None
         if self._conn is not None:
             await self._conn.close()
             self._conn = None
@@ -133,294 +410,341 @@ class Database:
     async def save_message_and_update_model(
         self, chat_id: int, author_id: int, raw_text: str, tokens: list[str]
     ) -> int:
-        """Атомарно сохраняет raw-сообщение и обновляет счётчики переходов n=3/n=2/n=1."""
-        starts2_pair: Optional[tuple[str, str]] = None
-        starts3_triplet: Optional[tuple[str, str, str]] = None
-
-        trans2_counter: Counter[tuple[str, str, str]] = Counter()
-        trans3_counter: Counter[tuple[str, str, str, str]] = Counter()
-        trans1_counter: Counter[tuple[str, str]] = Counter()
-
-        if len(tokens) >= 2:
-            starts2_pair = (tokens[0], tokens[1])
-            trans1_counter = Counter((tokens[i], tokens[i + 1]) for i in range(len(tokens) - 1))
-        if len(tokens) >= 3:
-            starts3_triplet = (tokens[0], tokens[1], tokens[2])
-            trans2_counter = Counter(
-                (tokens[i], tokens[i + 1], tokens[i + 2]) for i in range(len(tokens) - 2)
-            )
-        if len(tokens) >= 4:
-            trans3_counter = Counter(
-                (tokens[i], tokens[i + 1], tokens[i + 2], tokens[i + 3])
-                for i in range(len(tokens) - 3)
-            )
-
+        """Атомарно сохраняет raw-сообщение и обновляет счётчики переходов n=3/n=2/n=1.
+
+        Запись выполняет фоновый writer: сообщения, пришедшие одновременно, коммитятся
+        одной транзакцией. Возвращает объём модели чата после записи.
+        """
+        await self._get_conn()
+        future: asyncio.Future[int] = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_PendingMessage(chat_id, author_id, raw_text, tokens, future))
+        return await future
+
+    async def _writer_loop(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < WRITE_BATCH_MAX and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                try:
+                    await self._write_batch(batch)
+                except Exception:
+                    if len(batch) == 1:
+                        raise
+                    # Пакет откатился целиком: повторяем по одному, чтобы ошибка одного
+                    # сообщения не роняла остальные.
+                    for item in batch:
+                        try:
+                            await self._write_batch([item])
+                        except Exception as exc:
+                            _fail_pending(item, exc)
+            except Exception as exc:
+                for item in batch:
+                    _fail_pending(item, exc)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _write_batch(self, batch: list[_PendingMessage]) -> None:
         async with self._lock:
             db = await self._get_conn()
-
-            await db.execute(
-                """
-                INSERT INTO messages(chat_id, author_id, text)
-                VALUES (?, ?, ?)
-                """,
-                (chat_id, author_id, raw_text),
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                new_vocab: dict[str, int] = {}
+                volumes: dict[int, list[int]] = {}
+                results: list[int] = []
+                for item in batch:
+                    delta3, delta2, fetched = await self._write_message(db, item)
+                    new_vocab.update(fetched)
+                    chat_id = item.chat_id
+                    if chat_id in volumes:
+                        volumes[chat_id][0] += delta3
+                        volumes[chat_id][1] += delta2
+                    else:
+                        volumes[chat_id] = [
+                            self._vol3.get(chat_id, 0) + delta3,
+                            self._vol2.get(chat_id, 0) + delta2,
+                        ]
+                    volume3, volume2 = volumes[chat_id]
+                    results.append(volume3 if volume3 > 0 else volume2)
+                await db.execute("COMMIT")
+            except BaseException:
+                await db.execute("ROLLBACK")
+                raise
+
+            self._remember_vocab(
+                itertools.chain.from_iterable(item.tokens for item in batch), new_vocab
             )
-
-            if starts2_pair:
-                await db.execute(
-                    """
-                    INSERT INTO starts(chat_id, w1, w2, cnt)
-                    VALUES (?, ?, ?, 1)
-                    ON CONFLICT(chat_id, w1, w2)
-                    DO UPDATE SET cnt = cnt + 1
-                    """,
-                    (chat_id, starts2_pair[0], starts2_pair[1]),
-                )
-            if starts3_triplet:
-                await db.execute(
-                    """
-                    INSERT INTO starts3(chat_id, w1, w2, w3, cnt)
-                    VALUES (?, ?, ?, ?, 1)
-                    ON CONFLICT(chat_id, w1, w2, w3)
-                    DO UPDATE SET cnt = cnt + 1
-                    """,
-                    (chat_id, starts3_triplet[0], starts3_triplet[1], starts3_triplet[2]),
-                )
-            if trans1_counter:
-                await db.executemany(
-                    """
-                    INSERT INTO transitions1(chat_id, w1, w2, cnt)
-                    VALUES (?, ?, ?, ?)
-                    ON CONFLICT(chat_id, w1, w2)
-                    DO UPDATE SET cnt = cnt + excluded.cnt
-                    """,
-                    [(chat_id, w1, w2, cnt) for (w1, w2), cnt in trans1_counter.items()],
-                )
-            if trans2_counter:
-                await db.executemany(
-                    """
-                    INSERT INTO transitions(chat_id, w1, w2, w3, cnt)
-                    VALUES (?, ?, ?, ?, ?)
-                    ON CONFLICT(chat_id, w1, w2, w3)
-                    DO UPDATE SET cnt = cnt + excluded.cnt
-                    """,
-                    [
-                        (chat_id, w1, w2, w3, cnt)
-                        for (w1, w2, w3), cnt in trans2_counter.items()
-                    ],
-                )
-            if trans3_counter:
-                await db.executemany(
-                    """
-                    INSERT INTO transitions3(chat_id, w1, w2, w3, w4, cnt)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                    ON CONFLICT(chat_id, w1, w2, w3, w4)
-                    DO UPDATE SET cnt = cnt + excluded.cnt
-                    """,
-                    [
-                        (chat_id, w1, w2, w3, w4, cnt)
-                        for (w1, w2, w3, w4), cnt in trans3_counter.items()
-                    ],
-                )
-
-            cursor3 = await db.execute(
-                "SELECT COALESCE(SUM(cnt), 0) FROM transitions3 WHERE chat_id = ?",
-                (chat_id,),
+            for chat_id, (volume3, volume2) in volumes.items():
+                self._vol3[chat_id] = volume3
+                self._vol2[chat_id] = volume2
+            for item, volume in zip(batch, results):
+                self._remember_message_hash(item.chat_id, item.raw_text)
+                self._remember_text(item.chat_id, item.raw_text, True)
+                if not item.future.done():
+                    item.future.set_result(volume)
+
+    async def _write_message(
+        self, db: aiosqlite.Connection, item: _PendingMessage
+    ) -> tuple[int, int, dict[str, int]]:
+        """Пишет одно сообщение в открытой транзакции; возвращает прирост volume3/volume2."""
+        chat_id = item.chat_id
+        token_ids, fetched = await self._resolve_token_ids(db, item.tokens)
+        trans1_counter, trans2_counter, trans3_counter = count_ngrams(token_ids)
+
+        await db.execute(INSERT_MESSAGE_SQL, (chat_id, item.author_id, item.raw_text))
+        if len(token_ids) >= 2:
+            await db.execute(UPSERT_START2_SQL, (chat_id, *token_ids[:2]))
+        if len(token_ids) >= 3:
+            await db.execute(UPSERT_START3_SQL, (chat_id, *token_ids[:3]))
+        await self._upsert_counts(db, "transitions1", ("w1", "w2"), chat_id, trans1_counter)
+        await self._upsert_counts(db, "transitions", ("w1", "w2", "w3"), chat_id, trans2_counter)
+        await self._upsert_counts(
+            db, "transitions3", ("w1", "w2", "w3", "w4"), chat_id, trans3_counter
+        )
+        return sum(trans3_counter.values()), sum(trans2_counter.values()), fetched
+
+    async def _resolve_token_ids(
+        self, db: aiosqlite.Connection, tokens: list[str]
+    ) -> tuple[list[int], dict[str, int]]:
+        """Возвращает id токенов, добавляя в vocab новые слова; вторым значением — новые id."""
+        cache = self._vocab_ids
+        unknown = [word for word in dict.fromkeys(tokens) if word not in cache]
+        fetched: dict[str, int] = {}
+        for start in range(0, len(unknown), MAX_SQL_VARIABLES):
+            chunk = unknown[start : start + MAX_SQL_VARIABLES]
+            await db.execute(
+                f"INSERT OR IGNORE INTO vocab(word) VALUES {', '.join(['(?)'] * len(chunk))}",
+                chunk,
             )
-            volume3 = int((await cursor3.fetchone())[0] or 0)
-            cursor2 = await db.execute(
-                "SELECT COALESCE(SUM(cnt), 0) FROM transitions WHERE chat_id = ?",
-                (chat_id,),
+            cursor = await db.execute(
+                f"SELECT word, id FROM vocab WHERE word IN ({', '.join('?' * len(chunk))})",
+                chunk,
             )
-            volume2 = int((await cursor2.fetchone())[0] or 0)
+            fetched.update(await cursor.fetchall())
+        return [fetched[word] if word in fetched else cache[word] for word in tokens], fetched
+
+    def _remember_vocab(self, tokens: Iterable[str], fetched: dict[str, int]) -> None:
+        cache = self._vocab_ids
+        cache.update(fetched)
+        for word in tokens:
+            cache.move_to_end(word)
+        while len(cache) > VOCAB_CACHE_LIMIT:
+            cache.popitem(last=False)
+
+    async def _upsert_counts(
+        self,
+        db: aiosqlite.Connection,
+        table: str,
+        key_columns: tuple[str, ...],
+        chat_id: int,
+        counts: dict[tuple[int, ...], int],
+    ) -> None:
+        """Добавляет счётчики n-грамм одним CTE-upsert на чанк, строки идут в порядке ключа."""
+        if not counts:
+            return
+        width = len(key_columns) + 1
+        chunk_rows = (MAX_SQL_VARIABLES - 1) // width
+        # Отсортированные ключи проходят индекс таблицы последовательно, а не вразброс
+        # по страницам; на больших чатах это заметно сокращает чтения B-дерева.
+        items = sorted(counts.items())
+        for start in range(0, len(items), chunk_rows):
+            rows = min(len(items) - start, chunk_rows)
+            # Список параметров создаётся сразу нужного размера; chat_id стоит последним.
+            params: list[object] = [chat_id] * (rows * width + 1)
+            pos = 0
+            for key, cnt in itertools.islice(items, start, start + rows):
+                params[pos : pos + width - 1] = key
+                params[pos + width - 1] = cnt
+                pos += width
+            await db.execute(build_counts_upsert_sql(table, key_columns, rows), params)
+
+    async def _load_all_volumes(self, db: aiosqlite.Connection) -> None:
+        for sql, volumes in ((ALL_VOLUMES3_SQL, self._vol3), (ALL_VOLUMES2_SQL, self._vol2)):
+            cursor = await db.execute(sql)
+            volumes.clear()
+            volumes.update(await cursor.fetchall())
+
+    async def _chat_message_hashes(self, chat_id: int) -> Optional[set[int]]:
+        """Множество хэшей сообщений чата или None, если полагаться на него нельзя."""
+        hashes = self._message_hashes.pop(chat_id, None)
+        if hashes is not None:
+            self._message_hashes[chat_id] = hashes
+            return hashes
+        if chat_id in self._hashes_oversized or chat_id in self._hashes_loading:
+            return None
 
-            await db.commit()
-            return volume3 if volume3 > 0 else volume2
+        # Сообщения, закоммиченные после старта выборки, writer кладёт в pending.
+        pending = self._hashes_loading[chat_id] = set()
+        hashes = set()
+        try:
+            async with self._reader() as db:
+                async with db.execute(CHAT_MESSAGE_TEXTS_SQL, (chat_id,)) as cursor:
+                    async for (text,) in cursor:
+                        hashes.add(hash(text))
+                        if len(hashes) > MESSAGE_HASHES_LIMIT:
+                            self._hashes_oversized.add(chat_id)
+                            return None
+        finally:
+            del self._hashes_loading[chat_id]
+        hashes |= pending
+        self._message_hashes[chat_id] = hashes
+        self._message_hash_count += len(hashes)
+        self._trim_message_hashes()
+        return self._message_hashes.get(chat_id)
+
+    def _remember_message_hash(self, chat_id: int, text: str) -> None:
+        key = hash(text)
+        pending = self._hashes_loading.get(chat_id)
+        if pending is not None:
+            pending.add(key)
+        hashes = self._message_hashes.get(chat_id)
+        if hashes is not None and key not in hashes:
+            hashes.add(key)
+            self._message_hash_count += 1
+            self._trim_message_hashes()
+
+    def _trim_message_hashes(self) -> None:
+        while self._message_hash_count > MESSAGE_HASHES_LIMIT:
+            oldest = next(iter(self._message_hashes))
+            if len(self._message_hashes) == 1:
+                self._hashes_oversized.add(oldest)
+            self._message_hash_count -= len(self._message_hashes.pop(oldest))
 
     async def get_starts(self, chat_id: int) -> list[tuple[str, str, int]]:
-        async with self._lock:
-            db = await self._get_conn()
+        async with self._reader() as db:
             cursor = await db.execute(
-                "SELECT w1, w2, cnt FROM starts WHERE chat_id = ?",
+                """
+                SELECT v1.word, v2.word, s.cnt
+                FROM starts AS s
+                JOIN vocab AS v1 ON v1.id = s.w1
+                JOIN vocab AS v2 ON v2.id = s.w2
+                WHERE s.chat_id = ?
+                """,
                 (chat_id,),
             )
             rows = await cursor.fetchall()
-        return [(str(r[0]), str(r[1]), int(r[2])) for r in rows]
+        return rows
 
     async def get_starts3(self, chat_id: int) -> list[tuple[str, str, str, int]]:
-        async with self._lock:
-            db = await self._get_conn()
-            cursor = await db.execute(
-                "SELECT w1, w2, w3, cnt FROM starts3 WHERE chat_id = ?",
-                (chat_id,),
-            )
-            rows = await cursor.fetchall()
-        return [(str(r[0]), str(r[1]), str(r[2]), int(r[3])) for r in rows]
-
-    async def get_start_if_exists(
-        self, chat_id: int, w1: str, w2: str
-    ) -> Optional[tuple[str, str, int]]:
-        async with self._lock:
-            db = await self._get_conn()
-            cursor = await db.execute(
-                "SELECT w1, w2, cnt FROM starts WHERE chat_id = ? AND w1 = ? AND w2 = ?",
-                (chat_id, w1, w2),
-            )
-            row = await cursor.fetchone()
-        if not row:
-            return None
-        return str(row[0]), str(row[1]), int(row[2])
-
-    async def get_start3_if_exists(
-        self, chat_id: int, w1: str, w2: str, w3: str
-    ) -> Optional[tuple[str, str, str, int]]:
-        async with self._lock:
-            db = await self._get_conn()
+        async with self._reader() as db:
             cursor = await db.execute(
                 """
-                SELECT w1, w2, w3, cnt
-                FROM starts3
-                WHERE chat_id = ? AND w1 = ? AND w2 = ? AND w3 = ?
+                SELECT v1.word, v2.word, v3.word, s.cnt
+                FROM starts3 AS s
+                JOIN vocab AS v1 ON v1.id = s.w1
+                JOIN vocab AS v2 ON v2.id = s.w2
+                JOIN vocab AS v3 ON v3.id = s.w3
+                WHERE s.chat_id = ?
                 """,
-                (chat_id, w1, w2, w3),
+                (chat_id,),
             )
-            row = await cursor.fetchone()
-        if not row:
-            return None
-        return str(row[0]), str(row[1]), str(row[2]), int(row[3])
+            rows = await cursor.fetchall()
+        return rows
 
     async def get_transitions(self, chat_id: int, w1: str, w2: str) -> list[tuple[str, int]]:
-        async with self._lock:
-            db = await self._get_conn()
+        async with self._reader() as db:
             cursor = await db.execute(
                 """
-                SELECT w3, cnt
-                FROM transitions
-                WHERE chat_id = ? AND w1 = ? AND w2 = ?
+                SELECT v.word, t.cnt
+                FROM transitions AS t
+                JOIN vocab AS v ON v.id = t.w3
+                WHERE t.chat_id = ?
+                  AND t.w1 = (SELECT id FROM vocab WHERE word = ?)
+                  AND t.w2 = (SELECT id FROM vocab WHERE word = ?)
                 """,
                 (chat_id, w1, w2),
             )
             rows = await cursor.fetchall()
-        return [(str(r[0]), int(r[1])) for r in rows]
+        return rows
+
+    async def get_transitions_batch(
+        self, keys: Sequence[tuple[int, str, str]]
+    ) -> dict[tuple[int, str, str], list[tuple[str, int]]]:
+        """Переходы n=2 для нескольких ключей (chat_id, w1, w2) одним запросом на чанк."""
+        result: dict[tuple[int, str, str], list[tuple[str, int]]] = {key: [] for key in keys}
+        unique_keys = list(result)
+        chunk_rows = MAX_SQL_VARIABLES // 3
+        async with self._reader() as db:
+            for start in range(0, len(unique_keys), chunk_rows):
+                chunk = unique_keys[start : start + chunk_rows]
+                cursor = await db.execute(
+                    build_transitions_batch_sql(len(chunk)),
+                    [value for key in chunk for value in key],
+                )
+                for chat_id, w1, w2, word, cnt in await cursor.fetchall():
+                    result[(chat_id, w1, w2)].append((word, cnt))
+        return result
 
     async def get_transitions3(
         self, chat_id: int, w1: str, w2: str, w3: str
     ) -> list[tuple[str, int]]:
-        async with self._lock:
-            db = await self._get_conn()
+        async with self._reader() as db:
             cursor = await db.execute(
                 """
-                SELECT w4, cnt
-                FROM transitions3
-                WHERE chat_id = ? AND w1 = ? AND w2 = ? AND w3 = ?
+                SELECT v.word, t.cnt
+                FROM transitions3 AS t
+                JOIN vocab AS v ON v.id = t.w4
+                WHERE t.chat_id = ?
+                  AND t.w1 = (SELECT id FROM vocab WHERE word = ?)
+                  AND t.w2 = (SELECT id FROM vocab WHERE word = ?)
+                  AND t.w3 = (SELECT id FROM vocab WHERE word = ?)
                 """,
                 (chat_id, w1, w2, w3),
             )
             rows = await cursor.fetchall()
-        return [(str(r[0]), int(r[1])) for r in rows]
+        return rows
 
     async def get_transitions1(self, chat_id: int, w1: str) -> list[tuple[str, int]]:
-        async with self._lock:
-            db = await self._get_conn()
+        async with self._reader() as db:
             cursor = await db.execute(
                 """
-                SELECT w2, cnt
-                FROM transitions1
-                WHERE chat_id = ? AND w1 = ?
+                SELECT v.word, t.cnt
+                FROM transitions1 AS t
+                JOIN vocab AS v ON v.id = t.w2
+                WHERE t.chat_id = ?
+                  AND t.w1 = (SELECT id FROM vocab WHERE word = ?)
                 """,
                 (chat_id, w1),
             )
             rows = await cursor.fetchall()
-        return [(str(r[0]), int(r[1])) for r in rows]
+        return rows
 
     async def get_chat_token_volume(self, chat_id: int) -> int:
-        async with self._lock:
-            db = await self._get_conn()
-            cursor3 = await db.execute(
-                "SELECT COALESCE(SUM(cnt), 0) FROM transitions3 WHERE chat_id = ?",
-                (chat_id,),
-            )
-            volume3 = int((await cursor3.fetchone())[0] or 0)
-            if volume3 > 0:
-                return volume3
-
-            cursor2 = await db.execute(
-                "SELECT COALESCE(SUM(cnt), 0) FROM transitions WHERE chat_id = ?",
-                (chat_id,),
-            )
-            return int((await cursor2.fetchone())[0] or 0)
+        await self._get_conn()
+        volume3 = self._vol3.get(chat_id, 0)
+        return volume3 if volume3 > 0 else self._vol2.get(chat_id, 0)
 
     async def get_stats(self, chat_id: int) -> dict[str, int]:
-        async with self._lock:
-            db = await self._get_conn()
-            msg_count = int(
-                (
-                    await (
-                        await db.execute("SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,))
-                    ).fetchone()
-                )[0]
-            )
-            starts2_count = int(
-                (await (await db.execute("SELECT COUNT(*) FROM starts WHERE chat_id = ?", (chat_id,))).fetchone())[0]
-            )
-            starts3_count = int(
-                (await (await db.execute("SELECT COUNT(*) FROM starts3 WHERE chat_id = ?", (chat_id,))).fetchone())[0]
-            )
-            trans2_count = int(
-                (
-                    await (
-                        await db.execute("SELECT COUNT(*) FROM transitions WHERE chat_id = ?", (chat_id,))
-                    ).fetchone()
-                )[0]
-            )
-            trans3_count = int(
-                (
-                    await (
-                        await db.execute("SELECT COUNT(*) FROM transitions3 WHERE chat_id = ?", (chat_id,))
-                    ).fetchone()
-                )[0]
-            )
-            trans1_count = int(
-                (
-                    await (
-                        await db.execute("SELECT COUNT(*) FROM transitions1 WHERE chat_id = ?", (chat_id,))
-                    ).fetchone()
-                )[0]
-            )
-            volume2 = int(
-                (
-                    await (
-                        await db.execute(
-                            "SELECT COALESCE(SUM(cnt), 0) FROM transitions WHERE chat_id = ?",
-                            (chat_id,),
-                        )
-                    ).fetchone()
-                )[0]
-                or 0
-            )
-            volume3 = int(
-                (
-                    await (
-                        await db.execute(
-                            "SELECT COALESCE(SUM(cnt), 0) FROM transitions3 WHERE chat_id = ?",
-                            (chat_id,),
-                        )
-                    ).fetchone()
-                )[0]
-                or 0
-            )
-            volume1 = int(
-                (
-                    await (
-                        await db.execute(
-                            "SELECT COALESCE(SUM(cnt), 0) FROM transitions1 WHERE chat_id = ?",
-                            (chat_id,),
-                        )
-                    ).fetchone()
-                )[0]
-                or 0
+        async with self._reader() as db:
+            cursor = await db.execute(
+                """
+                SELECT
+                    (SELECT COUNT(*) FROM messages WHERE chat_id = :chat_id),
+                    (SELECT COUNT(*) FROM starts WHERE chat_id = :chat_id),
+                    (SELECT COUNT(*) FROM starts3 WHERE chat_id = :chat_id),
+                    (SELECT COUNT(*) FROM transitions WHERE chat_id = :chat_id),
+                    (SELECT COUNT(*) FROM transitions3 WHERE chat_id = :chat_id),
+                    (SELECT COUNT(*) FROM transitions1 WHERE chat_id = :chat_id),
+                    (SELECT COALESCE(SUM(cnt), 0) FROM transitions WHERE chat_id = :chat_id),
+                    (SELECT COALESCE(SUM(cnt), 0) FROM transitions3 WHERE chat_id = :chat_id),
+                    (SELECT COALESCE(SUM(cnt), 0) FROM transitions1 WHERE chat_id = :chat_id)
+                """,
+                {"chat_id": chat_id},
             )
+            row = await cursor.fetchone()
 
+        (
+            msg_count,
+            starts2_count,
+            starts3_count,
+            trans2_count,
+            trans3_count,
+            trans1_count,
+            volume2,
+            volume3,
+            volume1,
+        ) = row
         return {
             "messages": msg_count,
             "starts2": starts2_count,
@@ -435,22 +759,57 @@ class Database:
         }
 
     async def clear_chat(self, chat_id: int) -> None:
+        # Сообщения, поставленные в очередь до очистки, должны быть записаны до DELETE.
+        await self._queue.join()
         async with self._lock:
             db = await self._get_conn()
-            await db.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
-            await db.execute("DELETE FROM starts WHERE chat_id = ?", (chat_id,))
-            await db.execute("DELETE FROM starts3 WHERE chat_id = ?", (chat_id,))
-            await db.execute("DELETE FROM transitions WHERE chat_id = ?", (chat_id,))
-            await db.execute("DELETE FROM transitions3 WHERE chat_id = ?", (chat_id,))
-            await db.execute("DELETE FROM transitions1 WHERE chat_id = ?", (chat_id,))
-            await db.commit()
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                for table in ("messages", *MODEL_TABLES):
+                    await db.execute(f"DELETE FROM {table} WHERE chat_id = ?", (chat_id,))
+                await db.execute("COMMIT")
+            except BaseException:
+                await db.execute("ROLLBACK")
+                raise
+            self._vol3.pop(chat_id, None)
+            self._vol2.pop(chat_id, None)
+            self._seen_texts.pop(chat_id, None)
+            hashes = self._message_hashes.pop(chat_id, None)
+            if hashes is not None:
+                self._message_hash_count -= len(hashes)
+            self._hashes_oversized.discard(chat_id)
 
     async def message_exists(self, chat_id: int, text: str) -> bool:
-        async with self._lock:
-            db = await self._get_conn()
-            cursor = await db.execute(
-                "SELECT 1 FROM messages WHERE chat_id = ? AND text = ? LIMIT 1",
-                (chat_id, text),
-            )
-            row = await cursor.fetchone()
-        return row is not None
+        hashes = await self._chat_message_hashes(chat_id)
+        if hashes is not None and hash(text) not in hashes:
+            return False
+        # Совпадение хэша — почти всегда то же сообщение; коллизию отсекает SELECT. Он же
+        # отвечает за чаты, хэши которых недоступны (загрузка идёт или чат слишком велик).
+        seen = self._seen_texts.get(chat_id)
+        if seen is not None and text in seen:
+            seen.move_to_end(text)
+            return seen[text]
+
+        params = (chat_id, text)
+        try:
+            row = self._get_sync_reader().execute(MESSAGE_EXISTS_SQL, params).fetchone()
+        except sqlite3.OperationalError as exc:
+            if exc.sqlite_errorcode & 0xFF != sqlite3.SQLITE_BUSY:
+                raise
+            async with self._reader() as db:
+                cursor = await db.execute(MESSAGE_EXISTS_SQL, params)
+                row = await cursor.fetchone()
+        exists = row is not None
+        self._remember_text(chat_id, text, exists)
+        return exists
+
+    def _remember_text(self, chat_id: int, text: str, exists: bool) -> None:
+        seen = self._seen_texts.setdefault(chat_id, OrderedDict())
+        # Отрицательный результат не должен перетирать сохранение, случившееся параллельно.
+        if exists:
+            seen[text] = True
+        else:
+            seen.setdefault(text, False)
+        seen.move_to_end(text)
+        if len(seen) > SEEN_TEXTS_LIMIT:
+            seen.popitem(last=False)
@@ -1,11 +1,18 @@
 from __future__ import annotations
 
 import asyncio
+import atexit
+import contextlib
 import logging
+import logging.handlers
+import queue
 import random
+import re
 import time
+from collections import deque
 from dataclasses import dataclass, field
-from typing import Optional
+from functools import lru_cache
+from typing import Callable, Optional
 
 from aiogram import Bot, Dispatcher, F
 from aiogram.enums import ChatType
@@ -13,6 +20,7 @@ from aiogram.enums import MessageEntityType
 from aiogram.filters import Command
 from aiogram.types import Message
 from aiogram.enums import ChatAction
+from aiogram.exceptions import TelegramRetryAfter
 
 from db import Database
 from markov import MarkovGenerator, tokenize
@@ -46,6 +54,122 @@ class RuntimeState:
     learned_messages: dict[int, int] = field(default_factory=dict)
 
 
+STATE_GC_INTERVAL_SEC = 300.0
+
+
+def prune_reply_timestamps(
+    last_reply_ts: dict[int, float], min_cooldown_sec: int, now: float
+) -> int:
+    """Удаляет отметки последнего ответа, которые уже не влияют на cooldown."""
+    max_age = max(min_cooldown_sec * 2, 3600)
+    stale = [chat_id for chat_id, ts in last_reply_ts.items() if now - ts > max_age]
+    for chat_id in stale:
+        del last_reply_ts[chat_id]
+    return len(stale)
+
+
+SettingSetter = Callable[[RuntimeState, str], None]
+
+
+def _float_setter(name: str, low: float, high: float) -> SettingSetter:
+    def apply(state: RuntimeState, value: str) -> None:
+        parsed = float(value)
+        if not low <= parsed <= high:
+            raise ValueError
+        setattr(state, name, parsed)
+
+    return apply
+
+
+def _int_setter(name: str, low: int, high: Optional[int] = None) -> SettingSetter:
+    def apply(state: RuntimeState, value: str) -> None:
+        parsed = int(value)
+        if parsed < low or (high is not None and parsed > high):
+            raise ValueError
+        setattr(state, name, parsed)
+
+    return apply
+
+
+def _bool_setter(name: str) -> SettingSetter:
+    def apply(state: RuntimeState, value: str) -> None:
+        parsed = parse_bool(value)
+        if parsed is None:
+            raise ValueError
+        setattr(state, name, parsed)
+
+    return apply
+
+
+def _set_typing_min_ms(state: RuntimeState, value: str) -> None:
+    parsed = int(value)
+    if parsed < 0 or parsed > state.typing_max_ms:
+        raise ValueError
+    state.typing_min_ms = parsed
+
+
+def _set_typing_max_ms(state: RuntimeState, value: str) -> None:
+    parsed = int(value)
+    if parsed < state.typing_min_ms:
+        raise ValueError
+    state.typing_max_ms = parsed
+
+
+def _set_markov_order(state: RuntimeState, value: str) -> None:
+    parsed = int(value)
+    if parsed not in {2, 3} or state.backoff_min_order >= parsed:
+        raise ValueError
+    state.markov_order = parsed
+
+
+def _set_backoff_min_order(state: RuntimeState, value: str) -> None:
+    parsed = int(value)
+    if parsed not in {1, 2} or parsed >= state.markov_order:
+        raise ValueError
+    state.backoff_min_order = parsed
+
+
+def _set_reply_context_max_tokens(state: RuntimeState, value: str) -> None:
+    parsed = int(value)
+    if parsed < 2 or parsed < state.reply_context_last_tokens:
+        raise ValueError
+    state.reply_context_max_tokens = parsed
+
+
+def _set_reply_context_last_tokens(state: RuntimeState, value: str) -> None:
+    parsed = int(value)
+    if parsed not in {2, 3} or parsed > state.reply_context_max_tokens:
+        raise ValueError
+    state.reply_context_last_tokens = parsed
+
+
+# Ключи /set: каждый setter разбирает значение, проверяет его и присваивает полю
+# RuntimeState; некорректное значение — ValueError. Порядок — порядок в подсказке.
+SET_VALIDATORS: dict[str, SettingSetter] = {
+    "reply_probability": _float_setter("reply_probability", 0.0, 1.0),
+    "min_cooldown_sec": _int_setter("min_cooldown_sec", 0),
+    "min_tokens_for_model": _int_setter("min_tokens_for_model", 0),
+    "max_reply_chars": _int_setter("max_reply_chars", 20, 4000),
+    "normalize_lower": _bool_setter("normalize_lower"),
+    "typing_min_ms": _set_typing_min_ms,
+    "typing_max_ms": _set_typing_max_ms,
+    "randomness_strength": _float_setter("randomness_strength", 0.0, 3.0),
+    "repetition_penalty_strength": _float_setter("repetition_penalty_strength", 0.0, 3.0),
+    "markov_order": _set_markov_order,
+    "enable_backoff": _bool_setter("enable_backoff"),
+    "backoff_min_order": _set_backoff_min_order,
+    "use_reply_context": _bool_setter("use_reply_context"),
+    "reply_context_max_tokens": _set_reply_context_max_tokens,
+    "reply_context_last_tokens": _set_reply_context_last_tokens,
+    "reply_context_bias": _float_setter("reply_context_bias", 1.0, 4.0),
+    "reply_context_start_bias": _float_setter("reply_context_start_bias", 1.0, 4.0),
+    "reply_context_only_for_replies": _bool_setter("reply_context_only_for_replies"),
+    "reply_context_include_current_message": _bool_setter(
+        "reply_context_include_current_message"
+    ),
+}
+
+
 def is_group_message(message: Message) -> bool:
     return message.chat.type in {ChatType.GROUP, ChatType.SUPERGROUP}
 
@@ -54,12 +178,33 @@ def is_owner(message: Message, owner_id: Optional[int]) -> bool:
     return owner_id is not None and message.from_user is not None and message.from_user.id == owner_id
 
 
+# Список админов меняется редко: кэшируем его на чат, чтобы не ходить в Telegram API
+# на каждую управляющую команду.
+ADMIN_CACHE_TTL_SEC = 60.0
+_admin_cache: dict[int, tuple[float, frozenset[int]]] = {}
+
+
 async def is_chat_admin(bot: Bot, chat_id: int, user_id: int) -> bool:
-    admins = await bot.get_chat_administrators(chat_id)
-    for admin in admins:
-        if admin.user.id == user_id:
-            return True
-    return False
+    now = time.monotonic()
+    cached = _admin_cache.get(chat_id)
+    if cached is None or now - cached[0] >= ADMIN_CACHE_TTL_SEC:
+        admins = await bot.get_chat_administrators(chat_id)
+        cached = (now, frozenset(admin.user.id for admin in admins))
+        _admin_cache[chat_id] = cached
+    return user_id in cached[1]
+
+
+def prune_admin_cache(now: Optional[float] = None) -> int:
+    """Удаляет просроченные списки админов: иначе в кэше копится запись на каждый чат."""
+    now = time.monotonic() if now is None else now
+    stale = [
+        chat_id
+        for chat_id, (fetched_at, _) in _admin_cache.items()
+        if now - fetched_at >= ADMIN_CACHE_TTL_SEC
+    ]
+    for chat_id in stale:
+        del _admin_cache[chat_id]
+    return len(stale)
 
 
 async def can_manage_settings(
@@ -83,23 +228,35 @@ def extract_command_arg(text: str) -> str:
     return parts[1].strip()
 
 
+_BOOL_VALUES = {
+    "1": True,
+    "true": True,
+    "yes": True,
+    "on": True,
+    "0": False,
+    "false": False,
+    "no": False,
+    "off": False,
+}
+
+
 def parse_bool(value: str) -> Optional[bool]:
-    val = value.strip().lower()
-    if val in {"1", "true", "yes", "on"}:
-        return True
-    if val in {"0", "false", "no", "off"}:
-        return False
-    return None
+    return _BOOL_VALUES.get(value.strip().lower())
 
 
 BOT_TEXT_ALIASES = {"pepe", "пепе"}
 
 
-def text_contains_bot_alias(text: str, bot_aliases: set[str]) -> bool:
-    for chunk in tokenize(text, normalize_lower=True):
-        if chunk in bot_aliases:
-            return True
-    return False
+@lru_cache(maxsize=8)
+def mention_pattern(bot_username: str) -> re.Pattern[str]:
+    """@username бота или текстовый алиас отдельным словом, без учёта регистра.
+
+    Один проход regex по исходному тексту вместо lower() копии сообщения и его токенизации.
+    """
+    aliases = "|".join(re.escape(alias) for alias in sorted(BOT_TEXT_ALIASES))
+    return re.compile(
+        rf"@{re.escape(bot_username)}(?!\w)|(?<!\w)(?:{aliases})(?!\w)", re.IGNORECASE
+    )
 
 
 def bot_is_mentioned(message: Message, bot_username: str, bot_id: int) -> bool:
@@ -110,13 +267,12 @@ def bot_is_mentioned(message: Message, bot_username: str, bot_id: int) -> bool:
             and message.reply_to_message.from_user.id == bot_id
         )
 
-    username_mention = f"@{bot_username}".lower()
-    if username_mention in message.text.lower():
-        return True
-    if text_contains_bot_alias(message.text, BOT_TEXT_ALIASES):
+    if mention_pattern(bot_username).search(message.text) is not None:
         return True
 
     if message.entities:
+        # Entity MENTION может стоять вплотную к букве, которую regex считает частью слова.
+        username_mention = f"@{bot_username}".lower()
         for ent in message.entities:
             if ent.type == MessageEntityType.MENTION:
                 mention = message.text[ent.offset : ent.offset + ent.length]
@@ -156,25 +312,122 @@ def extract_context_tokens(
     return tokens[-max_tokens:] if len(tokens) > max_tokens else tokens
 
 
+class ReplyRateLimiter:
+    """Темп ответов в рамках лимитов Telegram: 20 сообщений/мин на группу, 30/с на бота.
+
+    Слот в чате резервируется заранее (скользящее окно), чтобы вызывающий знал, сколько
+    ждать; общий темп бота выдерживается непосредственно перед отправкой.
+    """
+
+    def __init__(
+        self,
+        chat_limit: int = 20,
+        chat_period_sec: float = 60.0,
+        global_per_sec: float = 30.0,
+    ) -> None:
+        self.chat_limit = chat_limit
+        self.chat_period_sec = chat_period_sec
+        self.global_interval_sec = 1.0 / global_per_sec
+        self._chat_slots: dict[int, deque[float]] = {}
+        self._blocked_until: dict[int, float] = {}
+        self._global_next = 0.0
+
+    def reserve(self, chat_id: int, now: Optional[float] = None) -> float:
+        """Резервирует слот отправки в чате и возвращает, сколько секунд до него ждать."""
+        now = time.monotonic() if now is None else now
+        slots = self._chat_slots.setdefault(chat_id, deque())
+        while slots and slots[0] <= now - self.chat_period_sec:
+            slots.popleft()
+        # Слоты чата идут по возрастанию: ответы в одном чате уходят в порядке резервирования.
+        slot = max(now, slots[-1] if slots else now, self._blocked_until.get(chat_id, 0.0))
+        if len(slots) >= self.chat_limit:
+            slot = max(slot, slots[-self.chat_limit] + self.chat_period_sec)
+        slots.append(slot)
+        return slot - now
+
+    def block(self, chat_id: int, retry_after_sec: float) -> None:
+        """Учитывает 429 от Telegram: до retry_after новых слотов в чате нет."""
+        self._blocked_until[chat_id] = time.monotonic() + retry_after_sec
+
+    def prune(self, now: Optional[float] = None) -> None:
+        """Забывает чаты, все слоты и блокировки которых уже в прошлом."""
+        now = time.monotonic() if now is None else now
+        horizon = now - self.chat_period_sec
+        idle = [c for c, slots in self._chat_slots.items() if not slots or slots[-1] <= horizon]
+        for chat_id in idle:
+            del self._chat_slots[chat_id]
+        for chat_id in [c for c, until in self._blocked_until.items() if until <= now]:
+            del self._blocked_until[chat_id]
+
+    async def pace(self) -> None:
+        now = time.monotonic()
+        send_at = max(now, self._global_next)
+        self._global_next = send_at + self.global_interval_sec
+        if send_at > now:
+            await asyncio.sleep(send_at - now)
+
+
 async def reply_humanized(
-    message: Message, text: str, typing_min_ms: int, typing_max_ms: int
+    message: Message,
+    text: str,
+    typing_min_ms: int,
+    typing_max_ms: int,
+    limiter: Optional[ReplyRateLimiter] = None,
 ) -> None:
+    wait_sec = limiter.reserve(message.chat.id) if limiter is not None else 0.0
+    if wait_sec * 1000 > typing_max_ms:
+        # Индикатор набора погаснет раньше, чем лимит позволит ответить: не шлём его.
+        await asyncio.sleep(wait_sec)
+    else:
+        started = time.monotonic()
+        try:
+            await message.bot.send_chat_action(chat_id=message.chat.id, action=ChatAction.TYPING)
+            delay_ms = random.randint(typing_min_ms, typing_max_ms)
+            await asyncio.sleep(max(delay_ms / 1000, wait_sec))
+        except Exception:
+            # Ошибка chat action не должна блокировать отправку обычного ответа.
+            pass
+        # Имитация набора необязательна, а слот лимитера — нет: если chat action упал,
+        # оставшуюся часть ожидания выдерживаем отдельно.
+        remaining = wait_sec - (time.monotonic() - started)
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+    if limiter is None:
+        await message.reply(text)
+        return
+
+    await limiter.pace()
     try:
-        await message.bot.send_chat_action(chat_id=message.chat.id, action=ChatAction.TYPING)
-        delay_ms = random.randint(typing_min_ms, typing_max_ms)
-        await asyncio.sleep(delay_ms / 1000)
-    except Exception:
-        # Ошибка chat action не должна блокировать отправку обычного ответа.
-        pass
-    await message.reply(text)
+        await message.reply(text)
+    except TelegramRetryAfter as exc:
+        limiter.block(message.chat.id, exc.retry_after)
+        await asyncio.sleep(limiter.reserve(message.chat.id))
+        await limiter.pace()
+        await message.reply(text)
+
+
+def setup_logging() -> None:
+    """Логи пишутся в stdout из отдельного потока, чтобы write() не блокировал event loop."""
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(
+        logging.Formatter("%(asctime)s | %(levelname)s | %(name)s | %(message)s")
+    )
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    # Без собственного formatter QueueHandler кладёт в очередь только текст сообщения,
+    # а полный формат применяет stream_handler в потоке listener.
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    # Остановка при выходе из процесса: listener должен дописать очередь, даже если
+    # run_bot упал ещё до polling (на db.init или get_me).
+    atexit.register(listener.stop)
 
 
 async def run_bot() -> None:
     settings: Settings = load_settings()
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
-    )
+    setup_logging()
     logger = logging.getLogger("chat_markov")
     logging.getLogger("aiogram").setLevel(logging.WARNING)
 
@@ -210,6 +463,11 @@ async def run_bot() -> None:
 
     dp = Dispatcher()
 
+    limiter = ReplyRateLimiter()
+
+    async def reply(message: Message, text: str) -> None:
+        await reply_humanized(message, text, state.typing_min_ms, state.typing_max_ms, limiter)
+
     @dp.message(Command("stats"))
     async def cmd_stats(message: Message) -> None:
         if not is_group_message(message):
@@ -223,7 +481,7 @@ async def run_bot() -> None:
             f"volume2: {stats['volume2']} | volume3: {stats['volume3']} | volume1: {stats['volume1']}\n"
             f"effective_volume: {stats['volume']}"
         )
-        await reply_humanized(message, text, state.typing_min_ms, state.typing_max_ms)
+        await reply(message, text)
 
     @dp.message(Command("help"))
     async def cmd_help(message: Message) -> None:
@@ -238,7 +496,7 @@ async def run_bot() -> None:
             "/setprob 0.2 - изменить вероятность ответов (OWNER_ID или админ)\n"
             '/seed "текст" - одноразово задать старт генерации (OWNER_ID или админ)'
         )
-        await reply_humanized(message, text, state.typing_min_ms, state.typing_max_ms)
+        await reply(message, text)
 
     @dp.message(Command("ping"))
     async def cmd_ping(message: Message) -> None:
@@ -269,170 +527,34 @@ async def run_bot() -> None:
             f"reply_context_include_current_message={state.reply_context_include_current_message}\n"
             "Изменения через /set действуют до перезапуска."
         )
-        await reply_humanized(message, text, state.typing_min_ms, state.typing_max_ms)
+        await reply(message, text)
 
     @dp.message(Command("set"))
     async def cmd_set(message: Message) -> None:
         if not await can_manage_settings(message, bot, settings.owner_id, logger):
-            await reply_humanized(
-                message,
-                "Команда доступна OWNER_ID и администраторам чата.",
-                state.typing_min_ms,
-                state.typing_max_ms,
-            )
+            await reply(message, "Команда доступна OWNER_ID и администраторам чата.")
             return
         raw = extract_command_arg(message.text or "")
         if not raw:
-            await reply_humanized(
-                message,
-                "Использование: /set <key> <value>",
-                state.typing_min_ms,
-                state.typing_max_ms,
-            )
+            await reply(message, "Использование: /set <key> <value>")
             return
         parts = raw.split(maxsplit=1)
         if len(parts) != 2:
-            await reply_humanized(
-                message,
-                "Использование: /set <key> <value>",
-                state.typing_min_ms,
-                state.typing_max_ms,
-            )
+            await reply(message, "Использование: /set <key> <value>")
             return
 
         key, value = parts[0].strip().lower(), parts[1].strip()
+        setter = SET_VALIDATORS.get(key)
+        if setter is None:
+            await reply(message, "Неизвестный ключ.\nДоступно: " + ", ".join(SET_VALIDATORS))
+            return
         try:
-            if key == "reply_probability":
-                v = float(value)
-                if not 0.0 <= v <= 1.0:
-                    raise ValueError
-                state.reply_probability = v
-            elif key == "min_cooldown_sec":
-                v = int(value)
-                if v < 0:
-                    raise ValueError
-                state.min_cooldown_sec = v
-            elif key == "min_tokens_for_model":
-                v = int(value)
-                if v < 0:
-                    raise ValueError
-                state.min_tokens_for_model = v
-            elif key == "max_reply_chars":
-                v = int(value)
-                if v < 20 or v > 4000:
-                    raise ValueError
-                state.max_reply_chars = v
-            elif key == "normalize_lower":
-                v_bool = parse_bool(value)
-                if v_bool is None:
-                    raise ValueError
-                state.normalize_lower = v_bool
-            elif key == "typing_min_ms":
-                v = int(value)
-                if v < 0 or v > state.typing_max_ms:
-                    raise ValueError
-                state.typing_min_ms = v
-            elif key == "typing_max_ms":
-                v = int(value)
-                if v < state.typing_min_ms:
-                    raise ValueError
-                state.typing_max_ms = v
-            elif key == "randomness_strength":
-                v = float(value)
-                if not 0.0 <= v <= 3.0:
-                    raise ValueError
-                state.randomness_strength = v
-            elif key == "repetition_penalty_strength":
-                v = float(value)
-                if not 0.0 <= v <= 3.0:
-                    raise ValueError
-                state.repetition_penalty_strength = v
-            elif key == "markov_order":
-                v = int(value)
-                if v not in {2, 3}:
-                    raise ValueError
-                if state.backoff_min_order >= v:
-                    raise ValueError
-                state.markov_order = v
-            elif key == "enable_backoff":
-                v_bool = parse_bool(value)
-                if v_bool is None:
-                    raise ValueError
-                state.enable_backoff = v_bool
-            elif key == "backoff_min_order":
-                v = int(value)
-                if v not in {1, 2} or v >= state.markov_order:
-                    raise ValueError
-                state.backoff_min_order = v
-            elif key == "use_reply_context":
-                v_bool = parse_bool(value)
-                if v_bool is None:
-                    raise ValueError
-                state.use_reply_context = v_bool
-            elif key == "reply_context_max_tokens":
-                v = int(value)
-                if v < 2 or v < state.reply_context_last_tokens:
-                    raise ValueError
-                state.reply_context_max_tokens = v
-            elif key == "reply_context_last_tokens":
-                v = int(value)
-                if v not in {2, 3} or v > state.reply_context_max_tokens:
-                    raise ValueError
-                state.reply_context_last_tokens = v
-            elif key == "reply_context_bias":
-                v = float(value)
-                if not 1.0 <= v <= 4.0:
-                    raise ValueError
-                state.reply_context_bias = v
-            elif key == "reply_context_start_bias":
-                v = float(value)
-                if not 1.0 <= v <= 4.0:
-                    raise ValueError
-                state.reply_context_start_bias = v
-            elif key == "reply_context_only_for_replies":
-                v_bool = parse_bool(value)
-                if v_bool is None:
-                    raise ValueError
-                state.reply_context_only_for_replies = v_bool
-            elif key == "reply_context_include_current_message":
-                v_bool = parse_bool(value)
-                if v_bool is None:
-                    raise ValueError
-                state.reply_context_include_current_message = v_bool
-            else:
-                await reply_humanized(
-                    message,
-                    (
-                        "Неизвестный ключ.\n"
-                        "Доступно: reply_probability, min_cooldown_sec, "
-                        "min_tokens_for_model, max_reply_chars, normalize_lower, "
-                        "typing_min_ms, typing_max_ms, randomness_strength, "
-                        "repetition_penalty_strength, "
-                        "markov_order, enable_backoff, backoff_min_order, "
-                        "use_reply_context, reply_context_max_tokens, "
-                        "reply_context_last_tokens, reply_context_bias, "
-                        "reply_context_start_bias, reply_context_only_for_replies, "
-                        "reply_context_include_current_message"
-                    ),
-                    state.typing_min_ms,
-                    state.typing_max_ms,
-                )
-                return
+            setter(state, value)
         except ValueError:
-            await reply_humanized(
-                message,
-                "Некорректное значение для этого ключа.",
-                state.typing_min_ms,
-                state.typing_max_ms,
-            )
+            await reply(message, "Некорректное значение для этого ключа.")
             return
 
-        await reply_humanized(
-            message,
-            f"Обновлено: {key}={value} (до перезапуска)",
-            state.typing_min_ms,
-            state.typing_max_ms,
-        )
+        await reply(message, f"Обновлено: {key}={value} (до перезапуска)")
 
     @dp.message(Command("clear"))
     async def cmd_clear(message: Message) -> None:
@@ -446,100 +568,64 @@ async def run_bot() -> None:
                 logger.warning("Cannot verify chat admins for /clear: %s", exc)
                 allowed = False
         if not allowed:
-            await reply_humanized(
-                message,
-                "Недостаточно прав. Нужен OWNER_ID или права админа чата.",
-                state.typing_min_ms,
-                state.typing_max_ms,
-            )
+            await reply(message, "Недостаточно прав. Нужен OWNER_ID или права админа чата.")
             return
         await db.clear_chat(message.chat.id)
         generator.invalidate_chat_cache(message.chat.id)
-        await reply_humanized(message, "Данные чата очищены.", state.typing_min_ms, state.typing_max_ms)
+        await reply(message, "Данные чата очищены.")
 
     @dp.message(Command("setprob"))
     async def cmd_setprob(message: Message) -> None:
         if not await can_manage_settings(message, bot, settings.owner_id, logger):
-            await reply_humanized(
-                message,
-                "Команда доступна OWNER_ID и администраторам чата.",
-                state.typing_min_ms,
-                state.typing_max_ms,
-            )
+            await reply(message, "Команда доступна OWNER_ID и администраторам чата.")
             return
 
         raw = extract_command_arg(message.text or "")
         if not raw:
-            await reply_humanized(
-                message, "Использование: /setprob 0.2", state.typing_min_ms, state.typing_max_ms
-            )
+            await reply(message, "Использование: /setprob 0.2")
             return
         try:
             value = float(raw)
         except ValueError:
-            await reply_humanized(
-                message, "Нужно число в диапазоне 0..1", state.typing_min_ms, state.typing_max_ms
-            )
+            await reply(message, "Нужно число в диапазоне 0..1")
             return
 
         if not 0.0 <= value <= 1.0:
-            await reply_humanized(
-                message,
-                "Значение должно быть в диапазоне 0..1",
-                state.typing_min_ms,
-                state.typing_max_ms,
-            )
+            await reply(message, "Значение должно быть в диапазоне 0..1")
             return
 
         state.reply_probability = value
-        await reply_humanized(
-            message, f"REPLY_PROBABILITY теперь: {value}", state.typing_min_ms, state.typing_max_ms
-        )
+        await reply(message, f"REPLY_PROBABILITY теперь: {value}")
 
     @dp.message(Command("seed"))
     async def cmd_seed(message: Message) -> None:
         if not await can_manage_settings(message, bot, settings.owner_id, logger):
-            await reply_humanized(
-                message,
-                "Команда доступна OWNER_ID и администраторам чата.",
-                state.typing_min_ms,
-                state.typing_max_ms,
-            )
+            await reply(message, "Команда доступна OWNER_ID и администраторам чата.")
             return
         raw = extract_command_arg(message.text or "")
         if not raw:
-            await reply_humanized(
-                message, 'Использование: /seed "ваш текст"', state.typing_min_ms, state.typing_max_ms
-            )
+            await reply(message, 'Использование: /seed "ваш текст"')
             return
 
         clean = sanitize_text(raw)
         tokens = tokenize(clean, normalize_lower=state.normalize_lower)
         if not tokens:
-            await reply_humanized(
-                message, "Не удалось извлечь токены из seed.", state.typing_min_ms, state.typing_max_ms
-            )
+            await reply(message, "Не удалось извлечь токены из seed.")
             return
 
         state.pending_seed[message.chat.id] = tokens[:3]
-        await reply_humanized(
-            message,
-            "Seed сохранен для следующей генерации (одноразово).",
-            state.typing_min_ms,
-            state.typing_max_ms,
-        )
-
-    @dp.message(F.text)
+        await reply(message, "Seed сохранен для следующей генерации (одноразово).")
+
+    # Личные сообщения, сообщения ботов и команды отсекаются фильтром роутера aiogram
+    # ещё до вызова хендлера.
+    @dp.message(
+        F.text,
+        F.chat.type.in_({ChatType.GROUP, ChatType.SUPERGROUP}),
+        F.from_user.is_bot.is_(False),
+        ~F.text.startswith("/"),
+    )
     async def on_text_message(message: Message) -> None:
-        if not is_group_message(message):
-            return
-        if message.from_user is None:
-            return
-        if message.from_user.is_bot:
-            return
         raw_text = message.text or ""
-        if raw_text.startswith("/"):
-            return
 
         clean = sanitize_text(raw_text)
         if len(clean) < 3 or len(clean) > 500:
@@ -547,12 +633,35 @@ async def run_bot() -> None:
             return
 
         tokens = tokenize(clean, normalize_lower=state.normalize_lower)
-        token_volume = await db.save_message_and_update_model(
-            chat_id=message.chat.id,
-            author_id=message.from_user.id,
-            raw_text=raw_text,
-            tokens=tokens,
+        # Запись идёт в фоне, пока считаются триггеры ответа и контекст; генерация
+        # начинается только после неё, чтобы видеть модель с этим сообщением.
+        save_task = asyncio.create_task(
+            db.save_message_and_update_model(
+                chat_id=message.chat.id,
+                author_id=message.from_user.id,
+                raw_text=raw_text,
+                tokens=tokens,
+            )
         )
+
+        now = time.time()
+        mentioned = bot_is_mentioned(message, bot_username, me.id)
+        last_ts = state.last_reply_ts.get(message.chat.id, 0.0)
+        cooldown_ok = now - last_ts >= state.min_cooldown_sec
+        wants_reply = mentioned or (cooldown_ok and random.random() < state.reply_probability)
+
+        context_tokens: list[str] = []
+        if wants_reply and state.use_reply_context:
+            context_tokens = extract_context_tokens(
+                message=message,
+                current_text=raw_text,
+                normalize_lower=state.normalize_lower,
+                max_tokens=state.reply_context_max_tokens,
+                only_for_replies=state.reply_context_only_for_replies,
+                include_current_message=state.reply_context_include_current_message,
+            )
+
+        token_volume = await save_task
         learned = state.learned_messages.get(message.chat.id, 0) + 1
         state.learned_messages[message.chat.id] = learned
         if learned == 1 or learned % 25 == 0:
@@ -562,17 +671,12 @@ async def run_bot() -> None:
                 learned,
                 token_volume,
             )
-        generator.invalidate_chat_cache(message.chat.id)
-
-        now = time.time()
-        mentioned = bot_is_mentioned(message, bot_username, me.id)
+        generator.invalidate_chat_cache(message.chat.id, keep_starts=True)
 
         enough_data = token_volume >= state.min_tokens_for_model
 
         if mentioned and not enough_data:
-            await reply_humanized(
-                message, "Пока мало материала, поболтайте ещё 🙂", state.typing_min_ms, state.typing_max_ms
-            )
+            await reply(message, "Пока мало материала, поболтайте ещё 🙂")
             return
 
         if not enough_data:
@@ -584,16 +688,7 @@ async def run_bot() -> None:
             )
             return
 
-        last_ts = state.last_reply_ts.get(message.chat.id, 0.0)
-        cooldown_ok = now - last_ts >= state.min_cooldown_sec
-
-        should_reply = False
-        if mentioned:
-            should_reply = True
-        elif cooldown_ok and random.random() < state.reply_probability:
-            should_reply = True
-
-        if not should_reply:
+        if not wants_reply:
             logger.debug(
                 "Skip by trigger/cooldown: chat=%s mentioned=%s cooldown_ok=%s prob=%.2f",
                 message.chat.id,
@@ -603,17 +698,6 @@ async def run_bot() -> None:
             )
             return
 
-        context_tokens: list[str] = []
-        if state.use_reply_context:
-            context_tokens = extract_context_tokens(
-                message=message,
-                current_text=raw_text,
-                normalize_lower=state.normalize_lower,
-                max_tokens=state.reply_context_max_tokens,
-                only_for_replies=state.reply_context_only_for_replies,
-                include_current_message=state.reply_context_include_current_message,
-            )
-
         seed = state.pending_seed.pop(message.chat.id, None)
         if seed is None and context_tokens:
             seed = context_tokens[-state.reply_context_last_tokens :]
@@ -648,25 +732,36 @@ async def run_bot() -> None:
 
         if not reply_text:
             if mentioned:
-                await reply_humanized(
-                    message,
-                    "Собираю мысли... Напишите ещё пару сообщений 🙂",
-                    state.typing_min_ms,
-                    state.typing_max_ms,
-                )
+                await reply(message, "Собираю мысли... Напишите ещё пару сообщений 🙂")
                 state.last_reply_ts[message.chat.id] = now
             logger.debug("Generation failed: chat=%s mentioned=%s", message.chat.id, mentioned)
             return
 
         state.last_reply_ts[message.chat.id] = now
-        await reply_humanized(message, reply_text, state.typing_min_ms, state.typing_max_ms)
+        await reply(message, reply_text)
+
+    async def gc_state() -> None:
+        # Словари по chat_id растут с каждым новым чатом; периодически убираем отжившее.
+        while True:
+            await asyncio.sleep(STATE_GC_INTERVAL_SEC)
+            removed = prune_reply_timestamps(
+                state.last_reply_ts, state.min_cooldown_sec, time.time()
+            )
+            limiter.prune()
+            prune_admin_cache()
+            if removed:
+                logger.debug("State GC: removed %s stale cooldown entries", removed)
 
     logger.info("Бот %s запущен (polling).", me.username)
     logger.info("Статус: работает.")
+    gc_task = asyncio.create_task(gc_state())
     try:
         await dp.start_polling(bot)
     finally:
         logger.info("Статус: остановка...")
+        gc_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await gc_task
         await db.close()
         await bot.session.close()
         logger.info("Статус: остановлен.")
@@ -1,35 +1,51 @@
 from __future__ import annotations
 
+import asyncio
+import bisect
 import random
 import re
-from collections import Counter, OrderedDict
+import sys
+import time
+from array import array
+from collections import Counter, deque
 from dataclasses import dataclass, field
-from typing import Optional
+from itertools import accumulate, islice, repeat
+from typing import Awaitable, Callable, Generic, Hashable, Iterable, Optional, Sequence, TypeVar
 
 from db import Database
 
 TOKEN_RE = re.compile(r"\w+|[.,!?;:]", re.UNICODE)
-PUNCT_SET = {".", ",", "!", "?", ";", ":"}
+PUNCT_SET = frozenset(".,!?;:")
+# Шаг сетки, на которую округляются степени весов в generate_text.
+POWER_STEP = 0.05
+
+T = TypeVar("T")
+H = TypeVar("H", bound=Hashable)
+
+
+_find_tokens = TOKEN_RE.findall
+# Выбор вызывается на каждом шаге генерации: методы общего Random связаны заранее,
+# без поиска атрибута в модуле random (random.seed по-прежнему на них действует).
+_random = random.random
+_choice = random.choice
 
 
 def tokenize(text: str, normalize_lower: bool = False) -> list[str]:
-    tokens = TOKEN_RE.findall(text)
-    return [t.lower() for t in tokens] if normalize_lower else tokens
+    # Один lower() на всю строку вместо lower() и нового списка на каждый токен.
+    return _find_tokens(text.lower() if normalize_lower else text)
 
 
 def detokenize(tokens: list[str], max_chars: int) -> str:
     if not tokens:
         return ""
 
-    parts: list[str] = []
-    for token in tokens:
-        if not parts:
-            parts.append(token)
-            continue
-        if token in PUNCT_SET:
-            parts[-1] = parts[-1] + token
-        else:
-            parts.append(" " + token)
+    # Каждая часть уже несёт свой разделитель: пунктуация приклеивается без пробела,
+    # а строки не склеиваются на месте, как было с parts[-1] + token.
+    parts = [tokens[0]]
+    append = parts.append
+    punct = PUNCT_SET
+    for token in islice(tokens, 1, None):
+        append(token if token in punct else " " + token)
 
     text = "".join(parts).strip()
     if len(text) > max_chars:
@@ -183,8 +199,22 @@ def context_decay(step_index: int) -> float:
     return 0.4
 
 
+def quantize_power(power: float) -> float:
+    return round(round(power / POWER_STEP) * POWER_STEP, 2)
+
+
+def weighted_choice_cum(population: Sequence[T], cum_weights: Sequence[float]) -> T:
+    """Выбирает элемент по накопленным весам одним бинарным поиском.
+
+    random.choices на каждом вызове заново валидирует аргументы и строит накопленные
+    веса; здесь они уже посчитаны, и выбор сводится к bisect по готовому списку.
+    """
+    threshold = _random() * cum_weights[-1]
+    return population[bisect.bisect_right(cum_weights, threshold, 0, len(cum_weights) - 1)]
+
+
 def weighted_next_choice(
-    items: list[tuple[str, int]],
+    items: list[tuple[str, int]] | TransitionRow,
     explore_probability: float,
     power: float,
     context_token_set: Optional[set[str]] = None,
@@ -198,16 +228,26 @@ def weighted_next_choice(
     seen_triplets: Optional[set[tuple[str, str, str]]] = None,
     repetition_penalty_strength: float = 1.0,
 ) -> str:
-    population = [token for token, _ in items]
-    if random.random() < explore_probability:
-        return random.choice(population)
-
+    row = items if isinstance(items, TransitionRow) else build_transition_row(items)
+    tokens = row.tokens
+    if _random() < explore_probability:
+        return _choice(tokens)
+    if row.uniform:
+        # Все счётчики равны: базовый вес один на всех, список cnt ** power не нужен.
+        # Контекстные бонусы и штрафы за повторы ниже применяются как обычно.
+        base_weights: Iterable[float] = repeat(max(row.counts[0], 1) ** power, len(tokens))
+    else:
+        # У строки из кэша генератора cnt ** power уже посчитаны для этой степени.
+        base_weights = row.base_weights(power)
     step_bias = 1.0 + (max(1.0, context_bias) - 1.0) * context_decay(step_index)
     penalty_strength = max(0.0, repetition_penalty_strength)
     recent_tokens = recent_tokens or []
-    weights: list[float] = []
-    for token, cnt in items:
-        weight = max(cnt, 1) ** power
+    # Накопленные веса строятся прямо в цикле: без отдельных списков population/weights
+    # и без второго прохода accumulate внутри random.choices.
+    cum_weights: list[float] = []
+    append = cum_weights.append
+    total = 0.0
+    for token, weight in zip(tokens, base_weights):
         if context_token_set and token in context_token_set:
             weight *= step_bias
         if current_state and context_pairs and len(current_state) >= 1:
@@ -235,83 +275,403 @@ def weighted_next_choice(
             if (current_state[-2], current_state[-1], token) in seen_triplets:
                 weight *= max(0.01, 1.0 - 0.94 * penalty_strength)
 
-        weight = max(weight, 0.01)
-        weights.append(weight)
-    return random.choices(population=population, weights=weights, k=1)[0]
+        total += max(weight, 0.01)
+        append(total)
+    return weighted_choice_cum(tokens, cum_weights)
 
 
-def weighted_start2_choice(items: list[tuple[str, str, int]], explore_probability: float, power: float) -> tuple[str, str]:
-    population = [(w1, w2) for w1, w2, _ in items]
-    if random.random() < explore_probability:
-        return random.choice(population)
-    weights = [max(cnt, 1) ** power for _, _, cnt in items]
-    return random.choices(population=population, weights=weights, k=1)[0]
+def build_alias_table(weights: Sequence[float]) -> tuple[list[float], list[int]]:
+    """Таблица Уолкера (метод Vose): O(n) на построение, O(1) на каждый выбор."""
+    n = len(weights)
+    total = sum(weights)
+    prob = [weight * n / total for weight in weights]
+    alias = list(range(n))
+    small = [index for index, p in enumerate(prob) if p < 1.0]
+    large = [index for index, p in enumerate(prob) if p >= 1.0]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        alias[less] = more
+        prob[more] -= 1.0 - prob[less]
+        (small if prob[more] < 1.0 else large).append(more)
+    # Остатки — погрешность округления: такие ячейки всегда отдают свой элемент.
+    for index in small + large:
+        prob[index] = 1.0
+    return prob, alias
 
 
-def weighted_start3_choice(
-    items: list[tuple[str, str, str, int]], explore_probability: float, power: float
-) -> tuple[str, str, str]:
-    population = [(w1, w2, w3) for w1, w2, w3, _ in items]
-    if random.random() < explore_probability:
-        return random.choice(population)
-    weights = [max(cnt, 1) ** power for _, _, _, cnt in items]
-    return random.choices(population=population, weights=weights, k=1)[0]
+def alias_choice(population: Sequence[T], prob: Sequence[float], alias: Sequence[int]) -> T:
+    index = min(int(_random() * len(population)), len(population) - 1)
+    return population[index] if _random() < prob[index] else population[alias[index]]
 
 
 @dataclass(slots=True)
-class MarkovGenerator:
-    db: Database
-    max_steps: int = 90
-    cache_limit: int = 1024
-
-    _cache3: OrderedDict[tuple[int, str, str, str], list[tuple[str, int]]] = field(
-        default_factory=OrderedDict, init=False
-    )
-    _cache2: OrderedDict[tuple[int, str, str], list[tuple[str, int]]] = field(
-        default_factory=OrderedDict, init=False
+class StartsTable:
+    """Стартовые n-граммы чата; alias-таблица строится один раз на каждую степень.
+
+    В больших чатах стартов тысячи, и выбор за O(1) не зависит от размера таблицы.
+    """
+
+    population: list[tuple[str, ...]]
+    counts: list[int]
+    _alias: dict[float, tuple[list[float], list[int]]] = field(default_factory=dict, init=False)
+    _index: Optional[dict[tuple[str, ...], int]] = field(default=None, init=False)
+
+    def __len__(self) -> int:
+        return len(self.population)
+
+    def count(self, start: tuple[str, ...]) -> int:
+        """Счётчик стартовой n-граммы или 0: заменяет точечный SELECT по starts/starts3."""
+        if self._index is None:
+            self._index = dict(zip(self.population, self.counts))
+        return self._index.get(start, 0)
+
+    def alias_table(self, power: float) -> tuple[list[float], list[int]]:
+        table = self._alias.get(power)
+        if table is None:
+            table = build_alias_table([max(cnt, 1) ** power for cnt in self.counts])
+            self._alias[power] = table
+        return table
+
+    def choice(self, explore_probability: float, power: float) -> tuple[str, ...]:
+        if _random() < explore_probability:
+            return _choice(self.population)
+        return alias_choice(self.population, *self.alias_table(power))
+
+
+def build_starts_table(rows: Sequence[tuple]) -> StartsTable:
+    return StartsTable(
+        population=[tuple(row[:-1]) for row in rows], counts=[row[-1] for row in rows]
     )
-    _cache1: OrderedDict[tuple[int, str], list[tuple[str, int]]] = field(
-        default_factory=OrderedDict, init=False
+
+
+@dataclass(slots=True)
+class TransitionRow:
+    """Переходы из одного состояния; базовые веса cnt ** power считаются один раз на степень.
+
+    Строка живёт в кэше генератора и переиспользуется между шагами и генерациями,
+    поэтому pow() по всем кандидатам не повторяется на каждом выборе.
+    """
+
+    tokens: tuple[str, ...]
+    # Счётчики без упаковки в int-объекты: array('Q') хранит их подряд по 8 байт.
+    counts: array[int]
+    # Все счётчики равны (типично для молодой модели, где почти всё встречено один раз).
+    uniform: bool = False
+    _weights: dict[float, list[float]] = field(default_factory=dict, init=False)
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def base_weights(self, power: float) -> list[float]:
+        # Ключ — ровно переданная степень; свести близкие степени к одной
+        # (quantize_power) должен вызывающий код, а не кэш.
+        weights = self._weights.get(power)
+        if weights is None:
+            if self.uniform:
+                weights = [max(self.counts[0], 1) ** power] * len(self.counts)
+            else:
+                weights = [max(cnt, 1) ** power for cnt in self.counts]
+            self._weights[power] = weights
+        return weights
+
+
+def build_transition_row(rows: Sequence[tuple[str, int]]) -> TransitionRow:
+    """Раскладывает строки (token, cnt) из БД на кортеж токенов и массив счётчиков."""
+    if not rows:
+        return TransitionRow(tokens=(), counts=array("Q"))
+    tokens, counts = zip(*rows)
+    # Один и тот же токен встречается в тысячах строк кэша: intern держит одну копию
+    # строки, и проверки по множествам n-грамм сравнивают её по идентичности.
+    return TransitionRow(
+        tokens=tuple(map(sys.intern, tokens)),
+        counts=array("Q", counts),
+        uniform=counts.count(counts[0]) == len(counts),
     )
 
-    def invalidate_chat_cache(self, chat_id: int) -> None:
-        for cache in (self._cache3, self._cache2, self._cache1):
-            keys = [k for k in cache if k[0] == chat_id]
-            for key in keys:
-                cache.pop(key, None)
-
-    def _touch_cache(self, cache: OrderedDict, key: tuple, value: list[tuple[str, int]]) -> None:
-        cache[key] = value
-        cache.move_to_end(key)
-        if len(cache) > self.cache_limit:
-            cache.popitem(last=False)
-
-    async def _get3(self, chat_id: int, w1: str, w2: str, w3: str) -> list[tuple[str, int]]:
-        key = (chat_id, w1, w2, w3)
-        if key in self._cache3:
-            self._cache3.move_to_end(key)
-            return self._cache3[key]
-        rows = await self.db.get_transitions3(chat_id, w1, w2, w3)
-        self._touch_cache(self._cache3, key, rows)
-        return rows
-
-    async def _get2(self, chat_id: int, w1: str, w2: str) -> list[tuple[str, int]]:
+
+def _retrieve_exception(future: asyncio.Future[object]) -> None:
+    """Помечает исключение future прочитанным, чтобы asyncio не ругался в лог."""
+    if not future.cancelled():
+        future.exception()
+
+
+class TransitionBatcher:
+    """Склеивает одновременные запросы переходов n=2 в один SELECT.
+
+    Пока запрос к БД выполняется, новые ключи копятся в очереди и уходят следующим
+    пакетом; одинаковые ключи из разных генераций ждут общий future.
+    """
+
+    def __init__(self, db: Database, max_batch_size: int = 64) -> None:
+        self.db = db
+        self.max_batch_size = max_batch_size
+        self._pending: dict[tuple[int, str, str], asyncio.Future[list[tuple[str, int]]]] = {}
+        self._task: Optional[asyncio.Task[None]] = None
+
+    async def get(self, chat_id: int, w1: str, w2: str) -> list[tuple[str, int]]:
         key = (chat_id, w1, w2)
-        if key in self._cache2:
-            self._cache2.move_to_end(key)
-            return self._cache2[key]
-        rows = await self.db.get_transitions(chat_id, w1, w2)
-        self._touch_cache(self._cache2, key, rows)
-        return rows
-
-    async def _get1(self, chat_id: int, w1: str) -> list[tuple[str, int]]:
-        key = (chat_id, w1)
-        if key in self._cache1:
-            self._cache1.move_to_end(key)
-            return self._cache1[key]
-        rows = await self.db.get_transitions1(chat_id, w1)
-        self._touch_cache(self._cache1, key, rows)
-        return rows
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            # Ошибку могут не забрать: все ожидающие уже отменены.
+            future.add_done_callback(_retrieve_exception)
+            self._pending[key] = future
+            if self._task is None or self._task.done():
+                self._task = asyncio.create_task(self._run())
+        # shield: отмена одного ожидающего не должна отменять общий future.
+        return await asyncio.shield(future)
+
+    async def _run(self) -> None:
+        batch: dict[tuple[int, str, str], asyncio.Future[list[tuple[str, int]]]] = {}
+        try:
+            # Даём корутинам, готовым в этой же итерации цикла, поставить свои ключи.
+            await asyncio.sleep(0)
+            while self._pending:
+                batch = dict(islice(self._pending.items(), self.max_batch_size))
+                for key in batch:
+                    del self._pending[key]
+                try:
+                    rows = await self.db.get_transitions_batch(list(batch))
+                except Exception as exc:
+                    for future in batch.values():
+                        if not future.done():
+                            future.set_exception(exc)
+                    continue
+                for key, future in batch.items():
+                    if not future.done():
+                        future.set_result(rows[key])
+        except BaseException:
+            # Задачу отменили (остановка бота): ключи уже вынуты из _pending или ждут
+            # в нём, и без отмены их ожидающие зависли бы навсегда.
+            for future in (*batch.values(), *self._pending.values()):
+                future.cancel()
+            self._pending.clear()
+            raise
+
+
+class RecentSet(Generic[H]):
+    """Последние maxlen уникальных элементов: переполнение вытесняет самый старый.
+
+    deque хранит порядок добавления, members — зеркальное множество для проверок
+    вхождения; его и передают в горячие циклы вместо самого объекта.
+    """
+
+    __slots__ = ("_order", "members")
+
+    def __init__(self, maxlen: int, items: Iterable[H] = ()) -> None:
+        self._order: deque[H] = deque(maxlen=maxlen)
+        self.members: set[H] = set()
+        for item in items:
+            self.add(item)
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def __contains__(self, item: object) -> bool:
+        return item in self.members
+
+    def add(self, item: H) -> None:
+        if item in self.members:
+            return
+        if len(self._order) == self._order.maxlen:
+            self.members.discard(self._order[0])
+        self._order.append(item)
+        self.members.add(item)
+
+
+class ShardedLRU(Generic[T]):
+    """LRU, разбитый по chat_id, с общим лимитом записей на все чаты.
+
+    Сброс чата — один pop шарда. Шарды упорядочены по последнему обращению к чату,
+    записи внутри шарда — по последнему обращению к ключу (pop и повторная вставка
+    в обычный dict). При переполнении вытесняется самая старая запись самого давно
+    использованного чата, так что один активный чат может занять весь бюджет.
+    """
+
+    __slots__ = ("shards", "limit", "chat_limit", "size")
+
+    def __init__(self, limit: int, chat_limit: int) -> None:
+        self.shards: dict[int, dict[tuple, T]] = {}
+        self.limit = limit
+        self.chat_limit = chat_limit
+        self.size = 0
+
+    def contains(self, chat_id: int, key: tuple) -> bool:
+        shard = self.shards.get(chat_id)
+        return shard is not None and key in shard
+
+    def get(self, chat_id: int, key: tuple) -> Optional[T]:
+        shard = self.shards.pop(chat_id, None)
+        if shard is None:
+            return None
+        self.shards[chat_id] = shard
+        value = shard.pop(key, None)
+        if value is not None:
+            shard[key] = value
+        return value
+
+    def put(self, chat_id: int, key: tuple, value: T) -> None:
+        shard = self.shards.pop(chat_id, None)
+        if shard is None:
+            shard = {}
+            if len(self.shards) >= self.chat_limit:
+                self.pop_chat(next(iter(self.shards)))
+        self.shards[chat_id] = shard
+        if shard.pop(key, None) is not None:
+            self.size -= 1
+        shard[key] = value
+        self.size += 1
+        while self.size > self.limit:
+            oldest_chat = next(iter(self.shards))
+            oldest = self.shards[oldest_chat]
+            del oldest[next(iter(oldest))]
+            self.size -= 1
+            if not oldest:
+                del self.shards[oldest_chat]
+
+    def pop_chat(self, chat_id: int) -> None:
+        shard = self.shards.pop(chat_id, None)
+        if shard is not None:
+            self.size -= len(shard)
+
+
+def discard_task(task: asyncio.Task) -> None:
+    """Отменяет ненужную задачу; если она уже упала, ошибка помечается полученной."""
+    if not task.cancel() and not task.cancelled():
+        task.exception()
+
+
+class MarkovGenerator:
+    __slots__ = (
+        "db",
+        "max_steps",
+        "starts_ttl_sec",
+        "_cache",
+        "_starts_cache",
+        "_batcher",
+        "_inflight",
+        "_generations",
+    )
+
+    def __init__(
+        self,
+        db: Database,
+        max_steps: int = 90,
+        cache_limit: int = 3072,
+        chat_cache_limit: int = 64,
+        starts_ttl_sec: float = 30.0,
+    ) -> None:
+        self.db = db
+        self.max_steps = max_steps
+        # Сколько секунд стартовые таблицы живут после загрузки, если чат не сбрасывали целиком.
+        self.starts_ttl_sec = starts_ttl_sec
+
+        # cache_limit — строк переходов суммарно во всех чатах, chat_cache_limit — чатов
+        # в каждом кэше. Ключ перехода — (порядок, *состояние): (3, w1, w2, w3),
+        # (2, w1, w2) или (1, w1); строки всех порядков делят один бюджет.
+        self._cache: ShardedLRU[TransitionRow] = ShardedLRU(cache_limit, chat_cache_limit)
+        # Стартовые таблицы по порядку вместе с моментом истечения (time.monotonic()):
+        # переживают обучение на новых сообщениях и перечитываются раз в starts_ttl_sec.
+        # На чат их не больше двух (n=3 и n=2).
+        self._starts_cache: ShardedLRU[tuple[float, StartsTable]] = ShardedLRU(
+            2 * chat_cache_limit, chat_cache_limit
+        )
+        self._batcher = TransitionBatcher(db)
+        # Загрузки из БД в процессе: параллельные промахи кэша по одному ключу ждут один запрос.
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        # Счётчик сбросов по чатам: загрузка, начатая до invalidate_chat_cache, не пишет
+        # устаревший результат в кэш и не отдаётся запросам, пришедшим после сброса.
+        # Одно int на чат, в котором бот хоть раз обучался.
+        self._generations: dict[int, int] = {}
+
+    def invalidate_chat_cache(self, chat_id: int, keep_starts: bool = False) -> None:
+        """Сбрасывает кэш чата; keep_starts оставляет стартовые таблицы до истечения TTL.
+
+        Новое сообщение лишь добавляет старты, поэтому после обучения их можно не
+        перечитывать сразу; после /clear сбрасывается всё. Исключение — пустая
+        таблица: первое же сообщение чата делает её неверной.
+        """
+        self._generations[chat_id] = self._generations.get(chat_id, 0) + 1
+        self._cache.pop_chat(chat_id)
+        starts = (self._starts_cache.get(chat_id, (order,)) for order in (2, 3))
+        if not keep_starts or any(entry is not None and not entry[1] for entry in starts):
+            self._starts_cache.pop_chat(chat_id)
+
+    async def _lru_get(
+        self,
+        cache: ShardedLRU[T],
+        chat_id: int,
+        key: tuple,
+        load: Callable[[], Awaitable[T]],
+    ) -> T:
+        value = cache.get(chat_id, key)
+        if value is None:
+            generation = self._generations.get(chat_id, 0)
+            value = await load()
+            if self._generations.get(chat_id, 0) == generation:
+                cache.put(chat_id, key, value)
+        return value
+
+    async def _load_once(self, key: tuple, load: Callable[[], Awaitable[T]]) -> T:
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(load())
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+            # Если все ожидающие отменены, ошибку загрузки больше некому прочитать.
+            future.add_done_callback(_retrieve_exception)
+        # shield: отмена одной генерации не должна обрывать загрузку для остальных.
+        return await asyncio.shield(future)
+
+    async def _get_starts(self, chat_id: int, order: int) -> StartsTable:
+        load = self.db.get_starts3 if order >= 3 else self.db.get_starts
+        key = (order,)
+        now = time.monotonic()
+        entry = self._starts_cache.get(chat_id, key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        generation = self._generations.get(chat_id, 0)
+        rows = await self._load_once(
+            ("starts", chat_id, generation, order), lambda: load(chat_id)
+        )
+        table = build_starts_table(rows)
+        if self._generations.get(chat_id, 0) == generation:
+            self._starts_cache.put(chat_id, key, (now + self.starts_ttl_sec, table))
+        return table
+
+    async def _get3(self, chat_id: int, w1: str, w2: str, w3: str) -> TransitionRow:
+        key = (chat_id, self._generations.get(chat_id, 0), w1, w2, w3)
+
+        async def load() -> TransitionRow:
+            return build_transition_row(
+                await self._load_once(key, lambda: self.db.get_transitions3(chat_id, w1, w2, w3))
+            )
+
+        return await self._lru_get(self._cache, chat_id, (3, w1, w2, w3), load)
+
+    async def _get2(self, chat_id: int, w1: str, w2: str) -> TransitionRow:
+        async def load() -> TransitionRow:
+            return build_transition_row(await self._batcher.get(chat_id, w1, w2))
+
+        return await self._lru_get(self._cache, chat_id, (2, w1, w2), load)
+
+    async def _get1(self, chat_id: int, w1: str) -> TransitionRow:
+        key = (chat_id, self._generations.get(chat_id, 0), w1)
+
+        async def load() -> TransitionRow:
+            return build_transition_row(
+                await self._load_once(key, lambda: self.db.get_transitions1(chat_id, w1))
+            )
+
+        return await self._lru_get(self._cache, chat_id, (1, w1), load)
+
+    def _prefetch3(
+        self, chat_id: int, w1: str, w2: str, w3: str
+    ) -> Optional[asyncio.Task[TransitionRow]]:
+        if self._cache.contains(chat_id, (3, w1, w2, w3)):
+            return None
+        return asyncio.create_task(self._get3(chat_id, w1, w2, w3))
 
     async def _select_contextual_start3(
         self,
@@ -327,23 +687,21 @@ class MarkovGenerator:
 
         candidates: list[tuple[tuple[str, str, str], float]] = []
         total = len(windows)
+        starts3 = await self._get_starts(chat_id, 3)
         for index, window in enumerate(windows):
-            seeded3 = await self.db.get_start3_if_exists(chat_id, window[0], window[1], window[2])
-            if not seeded3:
+            cnt = starts3.count(window)
+            if not cnt:
                 continue
             recency_bonus = 1.0 + ((index + 1) / total) * 0.35
-            weight = (max(seeded3[3], 1) ** power) * max(1.0, context_start_bias) * recency_bonus
-            candidates.append(((seeded3[0], seeded3[1], seeded3[2]), weight))
+            weight = (max(cnt, 1) ** power) * max(1.0, context_start_bias) * recency_bonus
+            candidates.append((window, weight))
 
         if not candidates:
             return None
-        if random.random() < explore_probability:
-            return random.choice([start for start, _ in candidates])
-        return random.choices(
-            population=[start for start, _ in candidates],
-            weights=[weight for _, weight in candidates],
-            k=1,
-        )[0]
+        population = [start for start, _ in candidates]
+        if _random() < explore_probability:
+            return _choice(population)
+        return weighted_choice_cum(population, list(accumulate(weight for _, weight in candidates)))
 
     async def _select_contextual_start2(
         self,
@@ -365,24 +723,24 @@ class MarkovGenerator:
 
         candidates: list[tuple[tuple[str, str], float]] = []
         total = len(windows)
+        starts2 = await self._get_starts(chat_id, 2)
         for index, window in enumerate(windows):
-            seeded2 = await self.db.get_start_if_exists(chat_id, window[0], window[1])
-            if not seeded2:
+            cnt = starts2.count(window)
+            if not cnt:
                 continue
             recency_bonus = 1.0 + ((index + 1) / total) * 0.30
-            weight = (max(seeded2[2], 1) ** power) * max(1.0, context_start_bias) * recency_bonus
-            candidates.append(((seeded2[0], seeded2[1]), weight))
+            weight = (max(cnt, 1) ** power) * max(1.0, context_start_bias) * recency_bonus
+            candidates.append((window, weight))
 
         if not candidates:
             return None
-        if random.random() < explore_probability:
-            w1, w2 = random.choice([start for start, _ in candidates])
+        population = [start for start, _ in candidates]
+        if _random() < explore_probability:
+            w1, w2 = _choice(population)
         else:
-            w1, w2 = random.choices(
-                population=[start for start, _ in candidates],
-                weights=[weight for _, weight in candidates],
-                k=1,
-            )[0]
+            w1, w2 = weighted_choice_cum(
+                population, list(accumulate(weight for _, weight in candidates))
+            )
 
         variants = await self._get2(chat_id, w1, w2)
         if not variants:
@@ -418,9 +776,11 @@ class MarkovGenerator:
         order = 3 if markov_order >= 3 else 2
         strength = max(0.0, min(3.0, randomness_strength))
         next_explore = min(0.98, 0.12 + 0.18 * strength)
-        next_power = max(0.15, 0.72 - 0.16 * strength)
+        # Степени округляются до сетки POWER_STEP: веса строк и alias-таблицы стартов
+        # кэшируются по степени, и близкие значения randomness_strength делят один кэш.
+        next_power = quantize_power(max(0.15, 0.72 - 0.16 * strength))
         start_explore = min(0.98, 0.20 + 0.20 * strength)
-        start_power = max(0.15, 0.75 - 0.18 * strength)
+        start_power = quantize_power(max(0.15, 0.75 - 0.18 * strength))
         jump_probability = min(0.32, 0.03 + 0.08 * strength)
 
         context_tokens = context_tokens or []
@@ -428,22 +788,23 @@ class MarkovGenerator:
         context_pairs = set(build_windows(context_tokens, 2))
         context_triplets = set(build_windows(context_tokens, 3))
 
-        starts3 = await self.db.get_starts3(chat_id) if order >= 3 else []
-        starts2 = await self.db.get_starts(chat_id)
+        # starts3 нужен и при order=2: по нему проверяется трёхсловный seed.
+        # Обе таблицы грузятся параллельно через разные соединения пула чтения.
+        all_starts3, starts2 = await asyncio.gather(
+            self._get_starts(chat_id, 3), self._get_starts(chat_id, 2)
+        )
+        starts3 = all_starts3 if order >= 3 else build_starts_table([])
         if not starts3 and not starts2:
             return ""
 
         start3: Optional[tuple[str, str, str]] = None
         if seed_tokens and len(seed_tokens) >= 3:
-            seeded3 = await self.db.get_start3_if_exists(
-                chat_id, seed_tokens[0], seed_tokens[1], seed_tokens[2]
-            )
-            if seeded3:
-                start3 = (seeded3[0], seeded3[1], seeded3[2])
+            seed3 = (seed_tokens[0], seed_tokens[1], seed_tokens[2])
+            if all_starts3.count(seed3):
+                start3 = seed3
         if start3 is None and seed_tokens and len(seed_tokens) >= 2:
-            seeded2 = await self.db.get_start_if_exists(chat_id, seed_tokens[0], seed_tokens[1])
-            if seeded2:
-                w1, w2 = seeded2[0], seeded2[1]
+            if starts2.count((seed_tokens[0], seed_tokens[1])):
+                w1, w2 = seed_tokens[0], seed_tokens[1]
                 variants = await self._get2(chat_id, w1, w2)
                 if variants:
                     w3 = weighted_next_choice(
@@ -482,9 +843,9 @@ class MarkovGenerator:
 
         if start3 is None:
             if starts3:
-                start3 = weighted_start3_choice(starts3, start_explore, start_power)
+                start3 = starts3.choice(start_explore, start_power)
             elif starts2:
-                w1, w2 = weighted_start2_choice(starts2, start_explore, start_power)
+                w1, w2 = starts2.choice(start_explore, start_power)
                 variants = await self._get2(chat_id, w1, w2)
                 if not variants:
                     return ""
@@ -505,32 +866,62 @@ class MarkovGenerator:
         if start3 is None:
             return ""
 
-        w1, w2, w3 = start3
+        w1, w2, w3 = map(sys.intern, start3)
         generated: list[str] = [w1, w2, w3]
-        visited_triplets: set[tuple[str, str, str]] = {(w1, w2, w3)}
-        seen_pairs = set(build_windows(generated, 2))
-        seen_triplets = set(build_windows(generated, 3))
+        visited_triplets: RecentSet[tuple[str, str, str]] = RecentSet(40, [(w1, w2, w3)])
+        seen_pairs: RecentSet[tuple[str, ...]] = RecentSet(80, build_windows(generated, 2))
+        seen_triplets: RecentSet[tuple[str, ...]] = RecentSet(80, build_windows(generated, 3))
         jump_count = 0
+        # Длина detokenize(generated) без обрезки: слово добавляет пробел и себя,
+        # пунктуация приклеивается к предыдущему токену.
+        text_len = len(w1) + sum(
+            len(token) if token in PUNCT_SET else len(token) + 1 for token in (w2, w3)
+        )
+        # Строка n=3 для следующего шага, загрузка которой уже запущена.
+        prefetched: Optional[asyncio.Task[TransitionRow]] = None
+        # Методы, вызываемые на каждом шаге, связаны один раз до цикла.
+        get3, get2, get1 = self._get3, self._get2, self._get1
+        append_token = generated.append
 
         for step_index in range(self.max_steps):
-            if len(generated) > 8 and random.random() < jump_probability and starts3 and order >= 3:
+            if len(generated) > 8 and _random() < jump_probability and starts3 and order >= 3:
                 contextual_jump = None
                 if context_tokens:
                     contextual_jump = await self._select_contextual_start3(
                         chat_id, context_tokens, start_explore, start_power, context_start_bias
                     )
                 if contextual_jump is None:
-                    contextual_jump = weighted_start3_choice(starts3, start_explore, start_power)
+                    contextual_jump = starts3.choice(start_explore, start_power)
                 w1, w2, w3 = contextual_jump
                 jump_count += 1
+                if prefetched is not None:
+                    discard_task(prefetched)
+                    prefetched = None
                 continue
 
-            pool3 = await self._get3(chat_id, w1, w2, w3) if order >= 3 else []
+            if order >= 3:
+                if prefetched is not None:
+                    pool3 = await prefetched
+                else:
+                    pool3 = await get3(chat_id, w1, w2, w3)
+                prefetched = None
+            else:
+                pool3 = []
             if pool3 and order >= 3:
-                candidates = [
-                    (cand, cnt) for cand, cnt in pool3 if (w2, w3, cand) not in visited_triplets
-                ]
-                pool = candidates or pool3
+                # Уже пройденные продолжения текущего состояния: visited_triplets не больше
+                # 40 элементов, а строка переходов бывает длинной, поэтому копия строки
+                # строится только при реальном пересечении.
+                blocked = {c for a, b, c in visited_triplets.members if a == w2 and b == w3}
+                pool: TransitionRow | list[tuple[str, int]] = pool3
+                if blocked and not blocked.isdisjoint(pool3.tokens):
+                    candidates = [
+                        (cand, cnt)
+                        for cand, cnt in zip(pool3.tokens, pool3.counts)
+                        if cand not in blocked
+                    ]
+                    # Если отфильтровано всё, остаётся кэшированная строка с готовыми весами.
+                    if candidates:
+                        pool = candidates
                 w4 = weighted_next_choice(
                     pool,
                     next_explore,
@@ -542,15 +933,15 @@ class MarkovGenerator:
                     context_bias=context_bias,
                     step_index=step_index,
                     recent_tokens=generated,
-                    seen_pairs=seen_pairs,
-                    seen_triplets=seen_triplets,
+                    seen_pairs=seen_pairs.members,
+                    seen_triplets=seen_triplets.members,
                     repetition_penalty_strength=repetition_penalty_strength,
                 )
             else:
                 if not enable_backoff and order >= 3:
                     break
 
-                pool2 = await self._get2(chat_id, w2, w3)
+                pool2 = await get2(chat_id, w2, w3)
                 if pool2:
                     w4 = weighted_next_choice(
                         pool2,
@@ -563,14 +954,14 @@ class MarkovGenerator:
                         context_bias=context_bias,
                         step_index=step_index,
                         recent_tokens=generated,
-                        seen_pairs=seen_pairs,
-                        seen_triplets=seen_triplets,
+                        seen_pairs=seen_pairs.members,
+                        seen_triplets=seen_triplets.members,
                         repetition_penalty_strength=repetition_penalty_strength,
                     )
                 else:
                     if not enable_backoff or backoff_min_order > 1:
                         break
-                    pool1 = await self._get1(chat_id, w3)
+                    pool1 = await get1(chat_id, w3)
                     if not pool1:
                         break
                     w4 = weighted_next_choice(
@@ -583,15 +974,18 @@ class MarkovGenerator:
                         context_bias=context_bias,
                         step_index=step_index,
                         recent_tokens=generated,
-                        seen_pairs=seen_pairs,
+                        seen_pairs=seen_pairs.members,
                         repetition_penalty_strength=repetition_penalty_strength,
                     )
 
-            generated.append(w4)
+            if order >= 3:
+                # Промах кэша по следующему состоянию грузится, пока идут проверки ниже.
+                prefetched = self._prefetch3(chat_id, w2, w3, w4)
+            append_token(w4)
             if has_degraded_recent_window(generated):
                 break
-            maybe_text = detokenize(generated, max_chars=max_chars)
-            if len(maybe_text) >= max_chars:
+            text_len += len(w4) if w4 in PUNCT_SET else len(w4) + 1
+            if text_len >= max_chars:
                 break
 
             w1, w2, w3 = w2, w3, w4
@@ -600,12 +994,9 @@ class MarkovGenerator:
                 seen_pairs.add((generated[-2], generated[-1]))
             if len(generated) >= 3:
                 seen_triplets.add((generated[-3], generated[-2], generated[-1]))
-            if len(visited_triplets) > 40:
-                visited_triplets.pop()
-            if len(seen_pairs) > 80:
-                seen_pairs.pop()
-            if len(seen_triplets) > 80:
-                seen_triplets.pop()
+
+        if prefetched is not None:
+            discard_task(prefetched)
 
         generated = trim_repetitive_tail(generated)
         result = detokenize(generated, max_chars=max_chars)
@@ -1,12 +1,15 @@
 from __future__ import annotations
 
+import asyncio
+import sqlite3
 import unittest
 import uuid
 from pathlib import Path
+from unittest import mock
 
 import aiosqlite
 
-from db import Database
+from db import SCHEMA_VERSION, Database
 
 
 class TestDatabaseLogic(unittest.IsolatedAsyncioTestCase):
@@ -70,6 +73,62 @@ class TestDatabaseLogic(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(stats["transitions1"], 4)
         self.assertEqual(stats["volume3"], 2)
 
+    async def test_get_transitions_batch_matches_single_lookups(self) -> None:
+        await self.db.save_message_and_update_model(
+            chat_id=2102, author_id=1, raw_text="а б в", tokens=["а", "б", "в"]
+        )
+        await self.db.save_message_and_update_model(
+            chat_id=2103, author_id=1, raw_text="а б г", tokens=["а", "б", "г"]
+        )
+
+        batch = await self.db.get_transitions_batch(
+            [(2102, "а", "б"), (2103, "а", "б"), (2102, "нет", "такого"), (2102, "а", "б")]
+        )
+        self.assertEqual(
+            batch,
+            {
+                (2102, "а", "б"): [("в", 1)],
+                (2103, "а", "б"): [("г", 1)],
+                (2102, "нет", "такого"): [],
+            },
+        )
+
+    async def test_long_message_is_counted_across_upsert_chunks(self) -> None:
+        tokens = [f"w{i}" for i in range(400)] + ["w0", "w1", "w2", "w3"]
+        volume = await self.db.save_message_and_update_model(
+            chat_id=2020,
+            author_id=88,
+            raw_text=" ".join(tokens),
+            tokens=tokens,
+        )
+        self.assertEqual(volume, len(tokens) - 3)
+
+        stats = await self.db.get_stats(2020)
+        self.assertEqual(stats["transitions1"], 400)
+        self.assertEqual(stats["volume1"], len(tokens) - 1)
+        self.assertEqual(stats["transitions3"], 400)
+        self.assertEqual(await self.db.get_transitions3(2020, "w0", "w1", "w2"), [("w3", 2)])
+
+    async def test_concurrent_saves_are_coalesced_with_running_volumes(self) -> None:
+        tokens = ["мы", "пишем", "в", "чат", "!"]
+        volumes = await asyncio.gather(
+            *(
+                self.db.save_message_and_update_model(
+                    chat_id=2121,
+                    author_id=author_id,
+                    raw_text=f"мы пишем в чат {author_id}",
+                    tokens=tokens,
+                )
+                for author_id in range(5)
+            )
+        )
+        self.assertEqual(sorted(volumes), [2, 4, 6, 8, 10])
+
+        stats = await self.db.get_stats(2121)
+        self.assertEqual(stats["messages"], 5)
+        self.assertEqual(stats["volume3"], 10)
+        self.assertEqual(await self.db.get_starts(2121), [("мы", "пишем", 5)])
+
     async def test_clear_chat(self) -> None:
         await self.db.save_message_and_update_model(
             chat_id=3003,
@@ -99,6 +158,83 @@ class TestDatabaseLogic(unittest.IsolatedAsyncioTestCase):
         self.assertTrue(await self.db.message_exists(4004, "hello world"))
         self.assertFalse(await self.db.message_exists(4004, "hello"))
 
+    async def test_message_exists_cache_follows_saves_and_clear(self) -> None:
+        self.assertFalse(await self.db.message_exists(4005, "hello world"))
+        await self.db.save_message_and_update_model(
+            chat_id=4005,
+            author_id=11,
+            raw_text="hello world",
+            tokens=["hello", "world"],
+        )
+        self.assertTrue(await self.db.message_exists(4005, "hello world"))
+        await self.db.clear_chat(4005)
+        self.assertFalse(await self.db.message_exists(4005, "hello world"))
+
+    def test_rejects_non_file_paths(self) -> None:
+        for path in ("", ":memory:", "file:markov.db?mode=memory"):
+            with self.assertRaises(ValueError):
+                Database(path)
+
+    async def test_message_hashes_load_lazily_and_evict_whole_chats(self) -> None:
+        for chat_id in (4006, 4008):
+            await self.db.save_message_and_update_model(
+                chat_id=chat_id,
+                author_id=11,
+                raw_text=f"hello {chat_id}",
+                tokens=["hello", str(chat_id)],
+            )
+        await self.db.close()
+        reopened = Database(str(self.db_path))
+        await reopened.init()
+        self.db = reopened
+        self.assertEqual(reopened._message_hashes, {})
+
+        with mock.patch("db.MESSAGE_HASHES_LIMIT", 2):
+            self.assertTrue(await reopened.message_exists(4006, "hello 4006"))
+            self.assertFalse(await reopened.message_exists(4006, "hello 9"))
+            self.assertTrue(await reopened.message_exists(4008, "hello 4008"))
+            self.assertEqual(list(reopened._message_hashes), [4006, 4008])
+
+            await reopened.save_message_and_update_model(
+                chat_id=4008, author_id=11, raw_text="again", tokens=["again"]
+            )
+            self.assertEqual(list(reopened._message_hashes), [4008])
+            self.assertEqual(reopened._message_hash_count, 2)
+            self.assertTrue(await reopened.message_exists(4008, "again"))
+
+            await reopened.save_message_and_update_model(
+                chat_id=4008, author_id=11, raw_text="third", tokens=["third"]
+            )
+            self.assertEqual(reopened._message_hashes, {})
+            self.assertIn(4008, reopened._hashes_oversized)
+            self.assertTrue(await reopened.message_exists(4008, "hello 4008"))
+            self.assertFalse(await reopened.message_exists(4008, "hello 9"))
+
+    async def test_message_exists_uses_reader_pool_when_sync_reader_is_busy(self) -> None:
+        await self.db.save_message_and_update_model(
+            chat_id=4007,
+            author_id=11,
+            raw_text="hello world",
+            tokens=["hello", "world"],
+        )
+        self.assertEqual(
+            self.db._get_sync_reader().execute("PRAGMA busy_timeout;").fetchone(), (0,)
+        )
+
+        class BusyReader:
+            def execute(self, *_: object) -> None:
+                exc = sqlite3.OperationalError("database is locked")
+                exc.sqlite_errorcode = sqlite3.SQLITE_BUSY
+                raise exc
+
+        sync_reader = self.db._sync_reader
+        self.db._sync_reader = BusyReader()  # type: ignore[assignment]
+        self.db._seen_texts.clear()
+        try:
+            self.assertTrue(await self.db.message_exists(4007, "hello world"))
+        finally:
+            self.db._sync_reader = sync_reader
+
     async def test_reopen_existing_database_preserves_chat_data(self) -> None:
         await self.db.save_message_and_update_model(
             chat_id=5005,
@@ -114,11 +250,21 @@ class TestDatabaseLogic(unittest.IsolatedAsyncioTestCase):
         try:
             after = await reopened.get_stats(5005)
             self.assertEqual(after, before)
+            self.assertEqual(await reopened.get_chat_token_volume(5005), before["volume"])
+            self.assertTrue(await reopened.message_exists(5005, "кофе утром бодрит"))
+            self.assertFalse(await reopened.message_exists(5005, "кофе утром"))
+            volume = await reopened.save_message_and_update_model(
+                chat_id=5005,
+                author_id=22,
+                raw_text="кофе утром бодрит всех",
+                tokens=["кофе", "утром", "бодрит", "всех"],
+            )
+            self.assertEqual(volume, (await reopened.get_stats(5005))["volume"])
         finally:
             await reopened.close()
             self.db = reopened
 
-    async def test_schema_stays_compatible_without_new_tables(self) -> None:
+    async def test_schema_stores_tokens_in_vocab(self) -> None:
         await self.db.close()
         async with aiosqlite.connect(str(self.db_path)) as conn:
             cursor = await conn.execute(
@@ -130,11 +276,150 @@ class TestDatabaseLogic(unittest.IsolatedAsyncioTestCase):
                 """
             )
             tables = [row[0] for row in await cursor.fetchall()]
+            cursor = await conn.execute(
+                """
+                SELECT name
+                FROM sqlite_master
+                WHERE type = 'table' AND sql LIKE '%WITHOUT ROWID'
+                ORDER BY name
+                """
+            )
+            without_rowid = [row[0] for row in await cursor.fetchall()]
+            cursor = await conn.execute("PRAGMA user_version;")
+            user_version = (await cursor.fetchone())[0]
 
         self.assertEqual(
             tables,
-            ["messages", "starts", "starts3", "transitions", "transitions1", "transitions3"],
+            [
+                "messages",
+                "starts",
+                "starts3",
+                "transitions",
+                "transitions1",
+                "transitions3",
+                "vocab",
+            ],
         )
+        self.assertEqual(
+            without_rowid, ["starts", "starts3", "transitions", "transitions1", "transitions3"]
+        )
+        self.assertEqual(user_version, SCHEMA_VERSION)
+
+        self.db = Database(str(self.db_path))
+        await self.db.init()
+
+    async def test_legacy_text_schema_is_migrated_to_vocab(self) -> None:
+        await self.db.close()
+        self.db_path.unlink()
+        async with aiosqlite.connect(str(self.db_path)) as conn:
+            await conn.executescript(
+                """
+                CREATE TABLE messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    author_id INTEGER NOT NULL,
+                    text TEXT NOT NULL,
+                    created_at TEXT NOT NULL DEFAULT (datetime('now'))
+                );
+                CREATE TABLE starts (
+                    chat_id INTEGER NOT NULL, w1 TEXT NOT NULL, w2 TEXT NOT NULL,
+                    cnt INTEGER NOT NULL DEFAULT 0, PRIMARY KEY(chat_id, w1, w2)
+                );
+                CREATE TABLE transitions (
+                    chat_id INTEGER NOT NULL, w1 TEXT NOT NULL, w2 TEXT NOT NULL,
+                    w3 TEXT NOT NULL, cnt INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY(chat_id, w1, w2, w3)
+                );
+                CREATE TABLE starts3 (
+                    chat_id INTEGER NOT NULL, w1 TEXT NOT NULL, w2 TEXT NOT NULL,
+                    w3 TEXT NOT NULL, cnt INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY(chat_id, w1, w2, w3)
+                );
+                CREATE TABLE transitions3 (
+                    chat_id INTEGER NOT NULL, w1 TEXT NOT NULL, w2 TEXT NOT NULL,
+                    w3 TEXT NOT NULL, w4 TEXT NOT NULL, cnt INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY(chat_id, w1, w2, w3, w4)
+                );
+                CREATE TABLE transitions1 (
+                    chat_id INTEGER NOT NULL, w1 TEXT NOT NULL, w2 TEXT NOT NULL,
+                    cnt INTEGER NOT NULL DEFAULT 0, PRIMARY KEY(chat_id, w1, w2)
+                );
+                CREATE INDEX idx_starts_lookup ON starts(chat_id, w1, w2);
+                CREATE INDEX idx_transitions3_lookup ON transitions3(chat_id, w1, w2, w3);
+                INSERT INTO messages(chat_id, author_id, text, created_at)
+                VALUES (6006, 1, 'кот спит дома днём', '2024-01-02 03:04:05');
+                INSERT INTO starts VALUES (6006, 'кот', 'спит', 2);
+                INSERT INTO starts3 VALUES (6006, 'кот', 'спит', 'дома', 2);
+                INSERT INTO transitions VALUES (6006, 'кот', 'спит', 'дома', 2);
+                INSERT INTO transitions3 VALUES (6006, 'кот', 'спит', 'дома', 'днём', 2);
+                INSERT INTO transitions1 VALUES (6006, 'дома', 'днём', 3);
+                """
+            )
+            await conn.commit()
 
         self.db = Database(str(self.db_path))
         await self.db.init()
+
+        self.assertEqual(await self.db.get_starts(6006), [("кот", "спит", 2)])
+        self.assertEqual(await self.db.get_starts3(6006), [("кот", "спит", "дома", 2)])
+        self.assertEqual(await self.db.get_transitions(6006, "кот", "спит"), [("дома", 2)])
+        self.assertEqual(
+            await self.db.get_transitions3(6006, "кот", "спит", "дома"), [("днём", 2)]
+        )
+        self.assertEqual(await self.db.get_transitions1(6006, "дома"), [("днём", 3)])
+
+        volume = await self.db.save_message_and_update_model(
+            chat_id=6006,
+            author_id=2,
+            raw_text="кот спит дома днём",
+            tokens=["кот", "спит", "дома", "днём"],
+        )
+        self.assertEqual(volume, 3)
+        self.assertEqual(await self.db.get_starts3(6006), [("кот", "спит", "дома", 3)])
+
+        async with aiosqlite.connect(str(self.db_path)) as conn:
+            cursor = await conn.execute(
+                "SELECT typeof(created_at), created_at FROM messages WHERE chat_id = 6006 ORDER BY id"
+            )
+            created = await cursor.fetchall()
+        self.assertEqual(created[0], ("integer", 1704164645))
+        self.assertEqual(created[1][0], "integer")
+
+    async def test_rowid_model_tables_are_migrated_to_without_rowid(self) -> None:
+        await self.db.save_message_and_update_model(
+            chat_id=7007,
+            author_id=1,
+            raw_text="кот спит дома днём",
+            tokens=["кот", "спит", "дома", "днём"],
+        )
+        await self.db.close()
+        # Откатываем таблицы модели к схеме user_version=1 (обычные rowid-таблицы).
+        async with aiosqlite.connect(str(self.db_path)) as conn:
+            for table in ("starts", "starts3", "transitions", "transitions1", "transitions3"):
+                await conn.execute(f"CREATE TABLE {table}_v1 AS SELECT * FROM {table};")
+                await conn.execute(f"DROP TABLE {table};")
+                await conn.execute(f"ALTER TABLE {table}_v1 RENAME TO {table};")
+            await conn.execute("PRAGMA user_version=1;")
+            await conn.commit()
+
+        self.db = Database(str(self.db_path))
+        await self.db.init()
+
+        self.assertEqual(await self.db.get_starts3(7007), [("кот", "спит", "дома", 1)])
+        self.assertEqual(
+            await self.db.get_transitions3(7007, "кот", "спит", "дома"), [("днём", 1)]
+        )
+        self.assertEqual(await self.db.get_transitions1(7007, "дома"), [("днём", 1)])
+        volume = await self.db.save_message_and_update_model(
+            chat_id=7007,
+            author_id=2,
+            raw_text="кот спит дома ночью",
+            tokens=["кот", "спит", "дома", "ночью"],
+        )
+        self.assertEqual(volume, 2)
+
+        async with aiosqlite.connect(str(self.db_path)) as conn:
+            cursor = await conn.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE sql LIKE '%WITHOUT ROWID'"
+            )
+            self.assertEqual((await cursor.fetchone())[0], 5)
@@ -1,24 +1,44 @@
 from __future__ import annotations
 
+import asyncio
 import random
+import time
 import unittest
 import uuid
 from pathlib import Path
 from types import SimpleNamespace
+from unittest import mock
 
 from db import Database
 from markov import (
     MarkovGenerator,
+    RecentSet,
+    ShardedLRU,
+    TransitionRow,
+    alias_choice,
+    build_alias_table,
+    build_transition_row,
     detokenize,
     has_degraded_recent_window,
     is_context_heavy_reply,
     is_low_diversity_reply,
     trim_repetitive_tail,
     tokenize,
+    weighted_choice_cum,
     weighted_next_choice,
 )
-from main import bot_is_mentioned, extract_context_tokens
-from text_utils import sanitize_text
+from main import (
+    SET_VALIDATORS,
+    ReplyRateLimiter,
+    RuntimeState,
+    bot_is_mentioned,
+    extract_context_tokens,
+    is_chat_admin,
+    prune_admin_cache,
+    prune_reply_timestamps,
+    reply_humanized,
+)
+from text_utils import normalize_repeats, remove_links, remove_mentions, sanitize_text
 
 
 class TestMarkovAndText(unittest.IsolatedAsyncioTestCase):
@@ -39,6 +59,20 @@ class TestMarkovAndText(unittest.IsolatedAsyncioTestCase):
         tokens = tokenize(clean)
         self.assertEqual(tokens, ["Привеет", "!", "!", "Как", "дела", "?", "?"])
 
+    def test_sanitize_matches_links_then_mentions_order(self) -> None:
+        samples = [
+            "смотри @vasyahttps://x.com ок",
+            "@https://x.com/a привет",
+            "a@https://t.me/x b",
+            "@PepeEdta_Bot HTTPS://X.Y/@user текст",
+            "@vasyahttpsfoo и @петя",
+            "ссылка@http:// оборвана",
+        ]
+        for text in samples:
+            with self.subTest(text=text):
+                legacy = " ".join(normalize_repeats(remove_mentions(remove_links(text))).split())
+                self.assertEqual(sanitize_text(text), legacy)
+
     def test_detokenize(self) -> None:
         text = detokenize(["Привет", ",", "мир", "!", "Как", "дела", "?"], max_chars=100)
         self.assertEqual(text, "Привет, мир! Как дела?")
@@ -134,6 +168,56 @@ class TestMarkovAndText(unittest.IsolatedAsyncioTestCase):
 
         self.assertGreater(tea_count, coffee_count)
 
+    def test_weighted_choice_cum_skips_zero_weight_items(self) -> None:
+        random.seed(3)
+        choices = {weighted_choice_cum(["а", "б", "в"], [0.0, 10.0, 10.0]) for _ in range(200)}
+        self.assertEqual(choices, {"б"})
+
+    def test_transition_row_reuses_base_weights_per_power(self) -> None:
+        random.seed(7)
+        row = build_transition_row([("чай", 1), ("кофе", 4)])
+        weights = row.base_weights(2.0)
+        self.assertEqual(weights, [1.0, 16.0])
+        self.assertIs(row.base_weights(2.0), weights)
+        self.assertEqual(row.base_weights(0.504), [1.0, 4**0.504])
+        picks = [weighted_next_choice(row, explore_probability=0.0, power=2.0) for _ in range(200)]
+        self.assertGreater(picks.count("кофе"), picks.count("чай"))
+
+        uniform = build_transition_row([("чай", 2), ("кофе", 2)])
+        self.assertTrue(uniform.uniform)
+        self.assertFalse(row.uniform)
+        self.assertEqual(uniform.base_weights(2.0), [4.0, 4.0])
+
+    def test_recent_set_evicts_oldest_item(self) -> None:
+        recent = RecentSet(2, ["а", "б"])
+        recent.add("б")
+        recent.add("в")
+        self.assertEqual(recent.members, {"б", "в"})
+        self.assertNotIn("а", recent)
+
+    def test_sharded_lru_keeps_one_global_budget(self) -> None:
+        cache: ShardedLRU[str] = ShardedLRU(limit=3, chat_limit=2)
+        cache.put(1, ("а",), "1а")
+        cache.put(1, ("б",), "1б")
+        cache.put(2, ("а",), "2а")
+        cache.put(2, ("б",), "2б")
+        self.assertEqual(cache.size, 3)
+        self.assertIsNone(cache.get(1, ("а",)))
+        self.assertEqual(cache.get(1, ("б",)), "1б")
+
+        cache.put(3, ("а",), "3а")
+        self.assertEqual(sorted(cache.shards), [1, 3])
+        self.assertEqual(cache.size, 2)
+        cache.pop_chat(1)
+        self.assertEqual(cache.size, 1)
+
+    def test_alias_table_follows_weights(self) -> None:
+        random.seed(5)
+        prob, alias = build_alias_table([0.0, 1.0, 3.0])
+        picks = [alias_choice(["а", "б", "в"], prob, alias) for _ in range(4000)]
+        self.assertNotIn("а", picks)
+        self.assertAlmostEqual(picks.count("в") / len(picks), 0.75, delta=0.03)
+
     def test_repetition_penalty_avoids_immediate_loop(self) -> None:
         random.seed(17)
         same_count = 0
@@ -195,11 +279,104 @@ class TestMarkovAndText(unittest.IsolatedAsyncioTestCase):
         message = SimpleNamespace(text="pepega сегодня победил", entities=None, reply_to_message=None)
         self.assertFalse(bot_is_mentioned(message, "PepeEdtaBot", 777))
 
+    def test_bot_is_mentioned_by_username_only_as_whole_mention(self) -> None:
+        message = SimpleNamespace(text="эй @pepeEDTAbot, ты тут?", entities=None, reply_to_message=None)
+        self.assertTrue(bot_is_mentioned(message, "PepeEdtaBot", 777))
+        message = SimpleNamespace(text="это @PepeEdtaBot_fan", entities=None, reply_to_message=None)
+        self.assertFalse(bot_is_mentioned(message, "PepeEdtaBot", 777))
+
     def test_bot_is_mentioned_by_reply_to_bot_message(self) -> None:
         reply_to_message = SimpleNamespace(from_user=SimpleNamespace(id=777))
         message = SimpleNamespace(text="слушай", entities=None, reply_to_message=reply_to_message)
         self.assertTrue(bot_is_mentioned(message, "PepeEdtaBot", 777))
 
+    async def test_is_chat_admin_caches_admin_list_per_chat(self) -> None:
+        calls = 0
+
+        async def get_chat_administrators(chat_id: int) -> list[SimpleNamespace]:
+            nonlocal calls
+            calls += 1
+            return [SimpleNamespace(user=SimpleNamespace(id=42))]
+
+        bot = SimpleNamespace(get_chat_administrators=get_chat_administrators)
+        self.assertTrue(await is_chat_admin(bot, -100777, 42))
+        self.assertFalse(await is_chat_admin(bot, -100777, 43))
+        self.assertEqual(calls, 1)
+
+        self.assertGreaterEqual(prune_admin_cache(now=time.monotonic() + 3600), 1)
+        self.assertTrue(await is_chat_admin(bot, -100777, 42))
+        self.assertEqual(calls, 2)
+
+    def test_reply_rate_limiter_spaces_replies_per_chat(self) -> None:
+        limiter = ReplyRateLimiter(chat_limit=2, chat_period_sec=60.0)
+        self.assertEqual(limiter.reserve(1, now=100.0), 0.0)
+        self.assertEqual(limiter.reserve(1, now=101.0), 0.0)
+        self.assertEqual(limiter.reserve(1, now=102.0), 58.0)
+        self.assertEqual(limiter.reserve(2, now=102.0), 0.0)
+        self.assertEqual(limiter.reserve(1, now=161.0), 0.0)
+
+    async def test_reply_humanized_waits_for_slot_when_chat_action_fails(self) -> None:
+        sent_at: list[float] = []
+
+        async def failing_chat_action(**_: object) -> None:
+            raise RuntimeError("429 on sendChatAction")
+
+        async def record_reply(_: str) -> None:
+            sent_at.append(time.monotonic())
+
+        message = SimpleNamespace(
+            chat=SimpleNamespace(id=1),
+            bot=SimpleNamespace(send_chat_action=failing_chat_action),
+            reply=record_reply,
+        )
+        limiter = ReplyRateLimiter(chat_limit=1, chat_period_sec=0.3)
+        for _ in range(2):
+            await reply_humanized(message, "привет", 0, 1000, limiter=limiter)
+
+        self.assertGreaterEqual(sent_at[1] - sent_at[0], 0.25)
+
+    def test_prune_reply_timestamps_keeps_recent_cooldowns(self) -> None:
+        last_reply_ts = {1: 10_000.0, 2: 5_000.0}
+        self.assertEqual(prune_reply_timestamps(last_reply_ts, 60, now=10_100.0), 1)
+        self.assertEqual(last_reply_ts, {1: 10_000.0})
+
+    def test_set_validators_apply_and_reject_values(self) -> None:
+        state = RuntimeState(
+            reply_probability=0.1,
+            min_cooldown_sec=30,
+            min_tokens_for_model=10,
+            max_reply_chars=200,
+            normalize_lower=False,
+            typing_min_ms=100,
+            typing_max_ms=500,
+            randomness_strength=1.0,
+            repetition_penalty_strength=1.0,
+            markov_order=3,
+            enable_backoff=True,
+            backoff_min_order=1,
+            use_reply_context=True,
+            reply_context_max_tokens=12,
+            reply_context_last_tokens=3,
+            reply_context_bias=1.5,
+            reply_context_start_bias=1.5,
+            reply_context_only_for_replies=False,
+            reply_context_include_current_message=True,
+        )
+        SET_VALIDATORS["reply_probability"](state, "0.35")
+        SET_VALIDATORS["normalize_lower"](state, "on")
+        self.assertEqual(state.reply_probability, 0.35)
+        self.assertTrue(state.normalize_lower)
+
+        for key, value in (
+            ("reply_probability", "1.5"),
+            ("typing_min_ms", "900"),
+            ("backoff_min_order", "3"),
+            ("enable_backoff", "maybe"),
+        ):
+            with self.assertRaises(ValueError):
+                SET_VALIDATORS[key](state, value)
+        self.assertEqual(state.typing_min_ms, 100)
+
     async def test_generate_text_with_seed(self) -> None:
         await self.db.save_message_and_update_model(
             chat_id=4444,
@@ -234,6 +411,29 @@ class TestMarkovAndText(unittest.IsolatedAsyncioTestCase):
         self.assertTrue(text.startswith("Я очень"))
         self.assertGreaterEqual(len(text), 5)
 
+    async def test_generate_text_weights_uniform_rows_without_base_weights(self) -> None:
+        await self.db.save_message_and_update_model(
+            chat_id=4445,
+            author_id=1,
+            raw_text="эхо эхо эхо ответ",
+            tokens=["эхо", "эхо", "эхо", "ответ"],
+        )
+
+        random.seed(5)
+        with mock.patch.object(
+            TransitionRow, "base_weights", side_effect=AssertionError("uniform row")
+        ), mock.patch("markov.weighted_choice_cum", wraps=weighted_choice_cum) as choose:
+            text = await self.generator.generate_text(
+                chat_id=4445,
+                max_chars=40,
+                seed_tokens=["эхо", "эхо"],
+                randomness_strength=0.0,
+                markov_order=2,
+            )
+        self.assertTrue(text.startswith("эхо эхо"))
+        # Выбор по равным строкам всё равно идёт через веса со штрафами за повторы.
+        self.assertTrue(choose.called)
+
     async def test_generate_text_uses_context_windows_for_start(self) -> None:
         await self.db.save_message_and_update_model(
             chat_id=5555,
@@ -328,6 +528,135 @@ class TestMarkovAndText(unittest.IsolatedAsyncioTestCase):
         self.assertTrue(text)
         self.assertTrue(text.startswith("утром люблю"))
 
+    async def test_starts_cache_is_reused_until_chat_invalidated(self) -> None:
+        await self.db.save_message_and_update_model(
+            chat_id=8888,
+            author_id=1,
+            raw_text="утром люблю чай",
+            tokens=["утром", "люблю", "чай"],
+        )
+        starts = await self.generator._get_starts(8888, 3)
+        self.assertEqual(starts.population, [("утром", "люблю", "чай")])
+
+        await self.db.save_message_and_update_model(
+            chat_id=8888,
+            author_id=2,
+            raw_text="вечером люблю кофе",
+            tokens=["вечером", "люблю", "кофе"],
+        )
+        self.assertIs(await self.generator._get_starts(8888, 3), starts)
+        self.generator.invalidate_chat_cache(8888, keep_starts=True)
+        self.assertIs(await self.generator._get_starts(8888, 3), starts)
+
+        await self.db.save_message_and_update_model(
+            chat_id=7777,
+            author_id=3,
+            raw_text="днём пью какао",
+            tokens=["днём", "пью", "какао"],
+        )
+        other = await self.generator._get_starts(7777, 3)
+        self.generator.invalidate_chat_cache(8888)
+        refreshed = await self.generator._get_starts(8888, 3)
+        self.assertEqual(len(refreshed), 2)
+        self.assertIs(await self.generator._get_starts(7777, 3), other)
+
+        self.generator.starts_ttl_sec = 0.0
+        self.generator.invalidate_chat_cache(7777)
+        expired = await self.generator._get_starts(7777, 3)
+        self.assertIsNot(await self.generator._get_starts(7777, 3), expired)
+
+    async def test_empty_starts_are_cached_until_first_message(self) -> None:
+        empty = await self.generator._get_starts(6666, 3)
+        self.assertFalse(empty)
+        self.assertIs(await self.generator._get_starts(6666, 3), empty)
+
+        await self.db.save_message_and_update_model(
+            chat_id=6666,
+            author_id=1,
+            raw_text="утром люблю чай",
+            tokens=["утром", "люблю", "чай"],
+        )
+        self.generator.invalidate_chat_cache(6666, keep_starts=True)
+        self.assertEqual(len(await self.generator._get_starts(6666, 3)), 1)
+
+    async def test_concurrent_cache_misses_share_one_db_query(self) -> None:
+        await self.db.save_message_and_update_model(
+            chat_id=9999,
+            author_id=1,
+            raw_text="утром люблю горячий чай",
+            tokens=["утром", "люблю", "горячий", "чай"],
+        )
+        calls = 0
+        original = self.db.get_transitions3
+
+        async def counting_get_transitions3(*args: object) -> list[tuple[str, int]]:
+            nonlocal calls
+            calls += 1
+            return await original(*args)
+
+        self.db.get_transitions3 = counting_get_transitions3  # type: ignore[method-assign]
+        results = await asyncio.gather(
+            *(self.generator._get3(9999, "утром", "люблю", "горячий") for _ in range(5))
+        )
+
+        self.assertEqual(calls, 1)
+        self.assertEqual([(row.tokens, list(row.counts)) for row in results], [(("чай",), [1])] * 5)
+
+    async def test_cancelled_batcher_cancels_waiting_loads(self) -> None:
+        hang = asyncio.Event()
+
+        async def hanging_batch(*_: object) -> dict[tuple[int, str, str], list[tuple[str, int]]]:
+            await hang.wait()
+            return {}
+
+        self.db.get_transitions_batch = hanging_batch  # type: ignore[method-assign]
+        batcher = self.generator._batcher
+        in_batch = asyncio.create_task(batcher.get(9997, "утром", "люблю"))
+        await asyncio.sleep(0.01)
+        queued = asyncio.create_task(batcher.get(9997, "люблю", "чай"))
+        await asyncio.sleep(0)
+        batcher._task.cancel()
+
+        for waiter in (in_batch, queued):
+            with self.assertRaises(asyncio.CancelledError):
+                await asyncio.wait_for(waiter, timeout=1)
+        self.assertEqual(batcher._pending, {})
+
+    async def test_load_started_before_invalidation_is_not_cached(self) -> None:
+        await self.db.save_message_and_update_model(
+            chat_id=9998,
+            author_id=1,
+            raw_text="утром люблю горячий чай",
+            tokens=["утром", "люблю", "горячий", "чай"],
+        )
+        original = self.db.get_transitions3
+        release = asyncio.Event()
+
+        async def slow_get_transitions3(*args: object) -> list[tuple[str, int]]:
+            rows = await original(*args)
+            await release.wait()
+            return rows
+
+        self.db.get_transitions3 = slow_get_transitions3  # type: ignore[method-assign]
+        stale_load = asyncio.create_task(self.generator._get3(9998, "утром", "люблю", "горячий"))
+        await asyncio.sleep(0.05)
+        await self.db.save_message_and_update_model(
+            chat_id=9998,
+            author_id=2,
+            raw_text="утром люблю горячий кофе",
+            tokens=["утром", "люблю", "горячий", "кофе"],
+        )
+        self.generator.invalidate_chat_cache(9998)
+        fresh_load = asyncio.create_task(self.generator._get3(9998, "утром", "люблю", "горячий"))
+        await asyncio.sleep(0.05)
+        release.set()
+
+        self.assertEqual((await stale_load).tokens, ("чай",))
+        self.assertEqual(set((await fresh_load).tokens), {"чай", "кофе"})
+        self.db.get_transitions3 = original  # type: ignore[method-assign]
+        cached = await self.generator._get3(9998, "утром", "люблю", "горячий")
+        self.assertEqual(set(cached.tokens), {"чай", "кофе"})
+
     def test_context_bias_does_not_override_repetition_penalty(self) -> None:
         random.seed(23)
         repeated_count = 0